@@ -1,25 +1,583 @@
+import os
 import pika
-import json
+import auth
+import rpc_codec
 import uuid
 import time
 import threading
+import collections
+import concurrent.futures
+import csv
+import re
+from urllib.parse import parse_qsl
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from prometheus_client import Counter, Histogram, start_http_server, generate_latest
+from prometheus_client import Counter, Gauge, Histogram, start_http_server, generate_latest, CONTENT_TYPE_LATEST
 
 # Метрики Prometheus
 REQUESTS = Counter('http_requests_total', 'Total HTTP Requests', ['method', 'endpoint', 'http_status'])
 LATENCY  = Histogram('http_request_latency_seconds', 'HTTP Request Latency', ['method', 'endpoint'])
+# Разбивка LATENCY по стадиям: разбор запроса, публикация в RabbitMQ и ожидание ответа воркера
+PARSE_LATENCY      = Histogram('http_request_parse_seconds', 'HTTP request parsing time', ['method', 'endpoint'])
+RPC_PUBLISH        = Histogram('rpc_publish_seconds', 'Time to publish an RPC request to RabbitMQ', ['queue'])
+RPC_REPLY_WAIT     = Histogram('rpc_reply_wait_seconds', 'Time from publish to worker reply', ['queue'])
+# Сброс нагрузки и дедлайны
+RPC_TIMEOUTS       = Counter('rpc_timeouts_total', 'RPC calls that hit their deadline', ['queue'])
+REQUESTS_SHED      = Counter('http_requests_shed_total', 'Requests rejected with 503', ['queue', 'reason'])
+RPC_IN_FLIGHT      = Gauge('rpc_in_flight', 'RPC calls waiting for a worker reply')
+QUEUE_DEPTH        = Gauge('rpc_queue_depth', 'Ready messages in a worker queue', ['queue'])
+# Проверка токенов сессии — микросекунды, отсюда и корзины
+AUTH_VERIFY_SECONDS = Histogram('auth_verify_seconds', 'Session token verification time',
+                                buckets=(5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3))
+AUTH_FAILURES      = Counter('auth_failures_total', 'Requests rejected by the session token check', ['reason'])
+# Запросы, получившие ответ чужого одновременного RPC (см. SingleFlight)
+RPC_COALESCED      = Counter('rpc_coalesced_total', 'Requests served by an identical in-flight RPC', ['queue'])
+
+# Кодек запросов к воркерам (RPC_CODEC=json|msgpack); ответы всегда просим в JSON,
+# чтобы их можно было отдать клиенту как есть
+REQUEST_CONTENT_TYPE = rpc_codec.content_type_for(rpc_codec.RPC_CODEC)
+# Отдавать тело ответа воркера клиенту без разбора (нужен x-status от воркера)
+RPC_PASSTHROUGH = os.environ.get('RPC_PASSTHROUGH', '1') == '1'
 
 # Костыль для демонстрации алерта по времени ответа
 ENABLE_LATENCY_HACK = False
 
-RABBITMQ_HOST           = 'rabbitmq'
+RABBITMQ_HOST           = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
 REGISTER_QUEUE          = 'register_queue'
 LOGIN_QUEUE             = 'login_queue'
 TRANSACTION_QUEUE       = 'transaction_queue'
 TRANSACTION_GET_QUEUE   = 'transaction_get_queue'
 DELETE_TRANSACTION_QUEUE= 'delete_transaction_queue'
 DELETE_USER_QUEUE       = 'delete_user_queue'
+SUMMARY_QUEUE           = 'summary_queue'
+TRANSACTION_BULK_QUEUE  = 'transaction_bulk_queue'
+TRANSACTION_EXPORT_QUEUE= 'transaction_export_queue'
+USER_DELETION_STATUS_QUEUE = 'user_deletion_status_queue'
+REVOKED_USERS_QUEUE = 'revoked_users_queue'
+
+# Content-Type выгрузки по формату
+EXPORT_CONTENT_TYPES = {
+    'csv':    'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Строк в одном сообщении массового импорта и предел ошибок в итоговом ответе
+BULK_CHUNK_ROWS  = int(os.environ.get('BULK_CHUNK_ROWS', 5000))
+BULK_MAX_ERRORS  = int(os.environ.get('BULK_MAX_ERRORS', 100))
+BULK_READ_BYTES  = 64 * 1024
+# Строка импорта длиннее этого не копится в памяти, а отбрасывается как ошибочная
+BULK_MAX_LINE_BYTES = int(os.environ.get('BULK_MAX_LINE_BYTES', 64 * 1024))
+
+def parse_queue_map(raw, cast=int):
+    """Разбирает строку вида "queue=value,queue2=value2" в словарь."""
+    result = {}
+    for item in filter(None, (part.strip() for part in raw.split(','))):
+        queue, _, value = item.partition('=')
+        result[queue.strip()] = cast(value)
+    return result
+
+
+# Дедлайн RPC по очереди, секунды: столько шлюз ждёт ответа (потом 504),
+# и после этого воркер выбрасывает сообщение не обрабатывая.
+# RPC_DEADLINES переопределяет отдельные очереди: "login_queue=3,transaction_bulk_queue=120"
+RPC_TIMEOUT = float(os.environ.get('RPC_TIMEOUT', 10))
+RPC_DEADLINES = {
+    TRANSACTION_BULK_QUEUE:   60,
+    TRANSACTION_EXPORT_QUEUE: 30,  # для выгрузки — ожидание каждого следующего куска
+    **parse_queue_map(os.environ.get('RPC_DEADLINES', ''), float),
+}
+
+# Сброс нагрузки: 503 с Retry-After вместо ожидания, если одновременных RPC
+# больше MAX_IN_FLIGHT или в очереди воркеров накопилось больше MAX_QUEUE_DEPTH
+# готовых сообщений (QUEUE_DEPTH_LIMITS — для отдельных очередей). 0 — без лимита.
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 256))
+MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH', 1000))
+QUEUE_DEPTH_LIMITS = parse_queue_map(os.environ.get('QUEUE_DEPTH_LIMITS', ''))
+QUEUE_DEPTH_POLL_INTERVAL = float(os.environ.get('QUEUE_DEPTH_POLL_INTERVAL', 1))
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', 1))
+# Как часто перечитывать удалённых пользователей, чьи токены отклоняются (см. RevokedUsers)
+AUTH_REVOCATION_REFRESH = float(os.environ.get('AUTH_REVOCATION_REFRESH', 30))
+# Сколько сообщений потокового ответа шлюз готов держать в памяти. Воркер
+# шлёт следующий кусок, только получив кредит (x-credit-to), так что при
+# исправном воркере в буфере не больше его STREAM_WINDOW; это — страховка
+STREAM_MAX_BUFFER = int(os.environ.get('STREAM_MAX_BUFFER', 16))
+STREAM_OVERFLOW_BODY = rpc_codec.dumps_json({'status': 'failure', 'error': 'Stream overflowed the gateway buffer'})
+# Сколько секунд держать простаивающее keep-alive соединение (у nginx — 60 с)
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 120))
+
+OVERLOADED_BODY = rpc_codec.dumps_json({'status': 'failure', 'error': 'Service overloaded, retry later'})
+TIMEOUT_BODY    = rpc_codec.dumps_json({'status': 'failure', 'error': 'Backend timeout'})
+
+# Ключ идемпотентности записи транзакции (заголовок Idempotency-Key)
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Всё остальное требует заголовка Authorization: Bearer <токен из /api/login>
+PUBLIC_ENDPOINTS  = {'/api/register', '/api/login', '/metrics'}
+# после удаления аккаунта его токен годится только на просмотр хода удаления
+REVOKED_ENDPOINTS = {'/api/user/{user_id}/deletion'}
+UNAUTHORIZED_BODY = rpc_codec.dumps_json({'status': 'failure', 'error': 'Missing or invalid session token'})
+FORBIDDEN_BODY    = rpc_codec.dumps_json({'status': 'failure', 'error': 'Access to another user is forbidden'})
+
+
+def deadline_for(queue_name):
+    return RPC_DEADLINES.get(queue_name, RPC_TIMEOUT)
+
+
+class RpcTimeout(Exception):
+    pass
+
+
+# Очереди воркеров, глубину которых опрашивает QueueDepthMonitor
+WORKER_QUEUES = (
+    LOGIN_QUEUE, REGISTER_QUEUE, TRANSACTION_GET_QUEUE, SUMMARY_QUEUE, USER_DELETION_STATUS_QUEUE,
+    TRANSACTION_QUEUE, DELETE_TRANSACTION_QUEUE, DELETE_USER_QUEUE, TRANSACTION_BULK_QUEUE,
+    TRANSACTION_EXPORT_QUEUE,
+)
+
+def rpc_properties(queue_name, reply_to, correlation_id):
+    """Свойства RPC-сообщения: адрес ответа, дедлайн и заголовки трассировки.
+
+    x-published-at позволяет воркеру посчитать время ожидания в очереди,
+    x-accept — кодек, в котором шлюз ждёт ответ. Дедлайн передаётся дважды:
+    expiration — брокеру (он выбрасывает просроченное из головы очереди),
+    x-deadline — воркеру (сообщение могло истечь уже после доставки).
+    """
+    now = time.time()
+    deadline = deadline_for(queue_name)
+    return pika.BasicProperties(
+        reply_to      = reply_to,
+        correlation_id= correlation_id,
+        delivery_mode = 2,
+        content_type  = REQUEST_CONTENT_TYPE,
+        expiration    = str(int(deadline * 1000)),
+        headers       = {'x-request-id': correlation_id, 'x-published-at': now,
+                         'x-deadline': now + deadline, 'x-accept': rpc_codec.JSON}
+    )
+
+
+class QueueDepthMonitor(threading.Thread):
+    """Фоновый опрос числа готовых сообщений в очередях воркеров (passive queue_declare)."""
+
+    def __init__(self, queues, interval=QUEUE_DEPTH_POLL_INTERVAL):
+        super().__init__(daemon=True, name='queue-depth-monitor')
+        self.queues   = list(queues)
+        self.interval = interval
+        self.depths   = {}
+
+    def run(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+                channel = connection.channel()
+                while True:
+                    for queue in self.queues:
+                        try:
+                            depth = channel.queue_declare(queue=queue, passive=True).method.message_count
+                        except pika.exceptions.ChannelClosedByBroker:
+                            # очередь ещё не объявлена воркерами
+                            channel, depth = connection.channel(), 0
+                        self.depths[queue] = depth
+                        QUEUE_DEPTH.labels(queue).set(depth)
+                    connection.sleep(self.interval)
+            except pika.exceptions.AMQPError as e:
+                print(f"Queue depth monitor lost RabbitMQ ({e}), retrying in 5s…")
+                self.depths = {}
+                time.sleep(5)
+
+
+class LoadShedder:
+    """Пускает RPC к воркерам, пока не превышены MAX_IN_FLIGHT и лимиты глубины очередей."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.lock      = threading.Lock()
+        self.monitor   = None
+
+    def start_monitor(self):
+        self.monitor = QueueDepthMonitor(WORKER_QUEUES)
+        self.monitor.start()
+
+    def try_acquire(self, queue_name):
+        limit = QUEUE_DEPTH_LIMITS.get(queue_name, MAX_QUEUE_DEPTH)
+        if limit and self.monitor is not None and self.monitor.depths.get(queue_name, 0) > limit:
+            REQUESTS_SHED.labels(queue_name, 'queue_depth').inc()
+            return False
+        with self.lock:
+            if MAX_IN_FLIGHT and self.in_flight >= MAX_IN_FLIGHT:
+                REQUESTS_SHED.labels(queue_name, 'in_flight').inc()
+                return False
+            self.in_flight += 1
+        RPC_IN_FLIGHT.inc()
+        return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        RPC_IN_FLIGHT.dec()
+
+
+SHEDDER = LoadShedder()
+
+
+class RevokedUsers(threading.Thread):
+    """Удалённые пользователи, чьи токены ещё не истекли.
+
+    Токен проверяется без БД, поэтому удаление пользователя его само не
+    отзывает. Шлюз добавляет пользователя сюда после успешного
+    DELETE /api/user/{id}, а раз в AUTH_REVOCATION_REFRESH секунд
+    перечитывает список у воркеров: так удаление видят и другие экземпляры
+    шлюза, и этот после перезапуска.
+    """
+
+    def __init__(self, interval=AUTH_REVOCATION_REFRESH):
+        super().__init__(daemon=True, name='revoked-users')
+        self.interval = interval
+        self.users    = frozenset()
+        self.recent   = set()  # добавленные с начала текущего опроса
+        self.lock     = threading.Lock()
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def add(self, user_id):
+        with self.lock:
+            self.recent.add(user_id)
+            self.users = self.users | {user_id}
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.recent = set()
+            try:
+                resp = get_rpc_client().call(REVOKED_USERS_QUEUE, {'within': auth.AUTH_TOKEN_TTL})
+                if resp.get('status') != 'success':
+                    raise ValueError(resp.get('error'))
+            except (RpcTimeout, ValueError, pika.exceptions.AMQPError) as e:
+                print(f"Failed to refresh revoked users ({e}), keeping the previous list")
+            else:
+                with self.lock:
+                    self.users = frozenset(resp['user_ids']) | self.recent
+            time.sleep(self.interval)
+
+
+REVOKED_USERS = RevokedUsers()
+
+
+def reply_body(properties, body):
+    """(статус воркера, JSON-тело для клиента) из ответа воркера.
+
+    Если воркер прислал x-status и JSON, тело уходит клиенту как есть;
+    иначе (старый воркер, другой кодек, RPC_PASSTHROUGH=0) — разбирается
+    и кодируется заново.
+    """
+    status = (properties.headers or {}).get('x-status')
+    if RPC_PASSTHROUGH and status is not None and properties.content_type in (None, rpc_codec.JSON):
+        return status, body
+    resp = rpc_codec.decode(body, properties.content_type)
+    return resp.get('status'), rpc_codec.dumps_json(resp)
+
+
+def authenticate(header, allow_revoked=False):
+    """user_id из заголовка Authorization; auth.InvalidToken, если токен не подходит.
+
+    allow_revoked пропускает токены удалённых пользователей (см. REVOKED_ENDPOINTS).
+    """
+    start = time.perf_counter()
+    try:
+        scheme, _, token = (header or '').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            raise auth.InvalidToken('missing')
+        user_id = auth.verify_token(token.strip())
+        if not allow_revoked and user_id in REVOKED_USERS:
+            raise auth.InvalidToken('revoked')
+        return user_id
+    except auth.InvalidToken as e:
+        AUTH_FAILURES.labels(e.reason).inc()
+        raise
+    finally:
+        AUTH_VERIFY_SECONDS.observe(time.perf_counter() - start)
+
+
+def bind_user(message, user_id):
+    """Подставляет в запрос user_id владельца токена; False, если клиент указал чужой."""
+    claimed = message.get('user_id')
+    if claimed not in (None, '') and str(claimed) != str(user_id):
+        return False
+    message['user_id'] = user_id
+    return True
+
+
+class BadRequest(ValueError):
+    """Тело запроса не разобрать; клиент получает 400 с текстом ошибки."""
+
+    def body(self):
+        return rpc_codec.dumps_json({'status': 'failure', 'error': f"Bad request: {self}"})
+
+
+def parse_json_body(raw):
+    """JSON-объект из тела запроса (пустое тело — пустой объект); BadRequest, если это не он."""
+    if not raw:
+        return {}
+    try:
+        message = rpc_codec.loads_json(raw)
+    except (ValueError, TypeError) as e:
+        raise BadRequest(f"malformed JSON body ({e})")
+    if not isinstance(message, dict):
+        raise BadRequest("JSON body must be an object")
+    return message
+
+
+def idempotency_key(header):
+    """Ключ из заголовка Idempotency-Key, а без него — новый на каждый запрос.
+
+    Свой ключ делает безопасной переотправку сообщения шлюзом и повторную
+    доставку воркеру; клиентский — ещё и повтор самого HTTP-запроса.
+    """
+    if not header:
+        return str(uuid.uuid4())
+    if len(header) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f"Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+    return header
+
+
+def login_reply(body):
+    """Дополняет успешный ответ воркера на логин токеном сессии."""
+    resp = rpc_codec.loads_json(body)
+    resp['token'], resp['expires_at'] = auth.issue_token(resp['user_id'])
+    return rpc_codec.dumps_json(resp)
+
+
+# Маршруты: (метод, шаблон пути, имя обработчика). Шаблон же служит меткой
+# endpoint в метриках, чтобы /api/transaction/17 и /api/transaction/18 не
+# заводили по отдельному ряду. async_gateway строит по ним свой роутер.
+ROUTES = [
+    ('GET',    '/metrics',                     'handle_metrics'),
+    ('GET',    '/api/transactions/export',     'handle_export'),
+    ('GET',    '/api/transactions',            'handle_transactions'),
+    ('GET',    '/api/summary',                 'handle_summary'),
+    ('GET',    '/api/user/{user_id}/deletion', 'handle_deletion_status'),
+    ('POST',   '/api/register',                'handle_register'),
+    ('POST',   '/api/login',                   'handle_login'),
+    ('POST',   '/api/transaction',             'handle_transaction'),
+    ('POST',   '/api/transactions/bulk',       'handle_bulk_import'),
+    ('DELETE', '/api/user/{user_id}',          'handle_delete_user'),
+    ('DELETE', '/api/transaction/{transaction_id}', 'handle_delete_transaction'),
+]
+
+
+def compile_routes(routes):
+    """{метод: ({путь: (имя, шаблон)}, [(regex, имя, шаблон)])} — пути без параметров ищутся в словаре."""
+    table = {}
+    for method, template, name in routes:
+        static, dynamic = table.setdefault(method, ({}, []))
+        if '{' in template:
+            pattern = re.sub(r'\\\{\w+\\\}', '([^/]+)', re.escape(template))
+            dynamic.append((re.compile(pattern + '$'), name, template))
+        else:
+            static[template] = (name, template)
+    return table
+
+
+COMPILED_ROUTES = compile_routes(ROUTES)
+
+
+def match_route(method, path):
+    """(имя обработчика, шаблон, параметры пути) или (None, None, ()), если маршрута нет."""
+    static, dynamic = COMPILED_ROUTES.get(method, ({}, []))
+    route = static.get(path)
+    if route is not None:
+        return route + ((),)
+    for regex, name, template in dynamic:
+        match = regex.match(path)
+        if match:
+            return name, template, match.groups()
+    return None, None, ()
+
+
+class SingleFlight:
+    """Склеивает одинаковые одновременные вызовы: fn выполняет первый, остальные ждут его результат.
+
+    Ответ не кешируется: ключ живёт, пока идёт вызов, так что склеенный
+    запрос видит данные не старее, чем если бы пришёл на мгновение раньше.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = concurrent.futures.Future()
+        if not leader:
+            RPC_COALESCED.labels(key[0]).inc()
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+READS = SingleFlight()
+
+
+def coalesce_key(queue_name, message):
+    """Ключ склеивания: очередь и параметры запроса (вместе с user_id) без учёта порядка."""
+    return queue_name, tuple(sorted((k, str(v)) for k, v in message.items()))
+
+
+def bulk_format(query, content_type):
+    """Формат импорта из ?format= или Content-Type: csv (по умолчанию) либо ndjson."""
+    fmt = query.get('format')
+    if fmt is None:
+        fmt = 'ndjson' if 'ndjson' in (content_type or '') else 'csv'
+    if fmt not in ('csv', 'ndjson'):
+        raise ValueError(f"Unsupported format: {fmt}")
+    return fmt
+
+
+class LineSplitter:
+    """Режет байтовые блоки тела запроса на строки без перевода строки.
+
+    Строка длиннее max_bytes возвращается как None: её начало отбрасывается
+    сразу, остаток — до следующего перевода строки, так что тело без единого
+    перевода строки не копится в памяти.
+    """
+
+    def __init__(self, max_bytes=BULK_MAX_LINE_BYTES):
+        self.max_bytes = max_bytes
+        self.tail      = b''
+        self.skipping  = False  # дочитываем отброшенную строку
+
+    def feed(self, block):
+        """Список строк, закончившихся в этом блоке."""
+        *complete, self.tail = (self.tail + block).split(b'\n')
+        lines = []
+        for line in complete:
+            if self.skipping:
+                self.skipping = False  # конец уже отброшенной строки
+            else:
+                lines.append(self._decode(line))
+        if len(self.tail) > self.max_bytes:
+            if not self.skipping:
+                lines.append(None)
+                self.skipping = True
+            self.tail = b''
+        return lines
+
+    def close(self):
+        """Последняя строка, если тело не кончается переводом строки."""
+        tail, self.tail = self.tail, b''
+        if self.skipping or not tail:
+            return []
+        return [self._decode(tail)]
+
+    def _decode(self, line):
+        if len(line) > self.max_bytes:
+            return None
+        return line.rstrip(b'\r').decode('utf-8', 'replace')
+
+
+def split_lines(blocks):
+    """Строки из потока байтовых блоков; слишком длинная строка — None."""
+    splitter = LineSplitter()
+    for block in blocks:
+        yield from splitter.feed(block)
+    yield from splitter.close()
+
+
+LINE_TOO_LONG = f"line is longer than {BULK_MAX_LINE_BYTES} bytes"
+
+
+class BulkChunker:
+    """Режет поток строк импорта на сообщения для transaction_bulk_queue.
+
+    Для CSV первая строка — заголовок, он уходит в каждый кусок. first_line
+    в сообщении — номер строки в исходном файле, чтобы ошибки ссылались на него.
+    """
+
+    def __init__(self, user_id, fmt, chunk_rows=BULK_CHUNK_ROWS):
+        self.user_id    = user_id
+        self.fmt        = fmt
+        self.chunk_rows = chunk_rows
+        self.header     = None
+        self.lines      = []
+        self.first_line = None
+        self.line_no    = 0
+
+    def feed(self, line):
+        """Добавляет строку; возвращает готовый кусок или None."""
+        self.line_no += 1
+        if self.fmt == 'csv' and self.header is None:
+            self.header = [name.strip() for name in next(csv.reader([line]), [])]
+            return None
+        if not self.lines:
+            self.first_line = self.line_no
+        self.lines.append(line)
+        if len(self.lines) >= self.chunk_rows:
+            return self.take()
+        return None
+
+    def skip(self):
+        """Пропускает отброшенную строку и возвращает её номер в файле."""
+        self.line_no += 1
+        return self.line_no
+
+    def take(self):
+        """Забирает накопленные строки (None, если их нет)."""
+        if not self.lines:
+            return None
+        chunk = {
+            'user_id':    self.user_id,
+            'format':     self.fmt,
+            'header':     self.header,
+            'first_line': self.first_line,
+            'lines':      self.lines,
+        }
+        self.lines = []
+        return chunk
+
+
+class BulkSummary:
+    """Сводит ответы воркеров по кускам в один ответ клиенту."""
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = 0
+        self.errors   = []
+        self.failed_chunks = 0
+
+    def add(self, chunk, resp):
+        self.inserted += resp.get('inserted', 0)
+        self.rejected += resp.get('rejected', 0)
+        if resp.get('status') != 'success':
+            self.failed_chunks += 1
+            self.errors.append({'line': chunk['first_line'], 'lines': len(chunk['lines']),
+                                'error': resp.get('error', 'chunk failed')})
+        self.errors.extend(resp.get('errors', []))
+        del self.errors[BULK_MAX_ERRORS:]
+
+    def reject(self, line_no, error):
+        """Строка отвергнута ещё в шлюзе и воркеру не отправлялась."""
+        self.rejected += 1
+        if len(self.errors) < BULK_MAX_ERRORS:
+            self.errors.append({'line': line_no, 'error': error})
+
+    def result(self):
+        if self.failed_chunks == 0:
+            status = 'success'
+        else:
+            status = 'partial' if self.inserted else 'failure'
+        return {'status': status, 'inserted': self.inserted, 'rejected': self.rejected, 'errors': self.errors}
+
 
 # Thread–local хранение RPC‑клиента
 _thread_local = threading.local()
@@ -64,28 +622,38 @@ class RpcClient:
                 time.sleep(5)
 
     def on_response(self, ch, method, properties, body):
-        """Пришёл ответ — сохраняем в self.response."""
-        if properties.correlation_id == self.correlation_id:
-            self.response = json.loads(body)
+        """Пришёл ответ — сохраняем в self.response (кусок потока — в self.stream_buffer)."""
+        if properties.correlation_id != self.correlation_id:
+            return
+        headers = properties.headers or {}
+        kind = headers.get('x-stream')
+        if kind is not None:
+            if len(self.stream_buffer) >= STREAM_MAX_BUFFER:
+                # воркер не ждёт кредитов: обрываем поток, а не копим его в памяти
+                self.stream_buffer.clear()
+                self.stream_buffer.append(('error', STREAM_OVERFLOW_BODY, None))
+                self.correlation_id = None
+                return
+            self.stream_buffer.append((kind, body, headers.get('x-credit-to')))
+        else:
+            self.response = (properties, body)
 
-    def call(self, queue_name, message):
-        """Посылаем RPC‑запрос и ждём ответа."""
+    def publish(self, queue_name, message):
+        """Публикует запрос с новым correlation_id, возвращает время публикации."""
         self.response       = None
+        self.stream_buffer  = collections.deque()
         self.correlation_id = str(uuid.uuid4())
 
         if self.channel is None or self.channel.is_closed:
             self.connect()
 
+        started = time.time()
         try:
             self.channel.basic_publish(
                 exchange='',
                 routing_key=queue_name,
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    reply_to      = self.callback_queue,
-                    correlation_id= self.correlation_id,
-                    delivery_mode = 2
-                )
+                body=rpc_codec.encode(message, REQUEST_CONTENT_TYPE),
+                properties=rpc_properties(queue_name, self.callback_queue, self.correlation_id)
             )
         except (pika.exceptions.ChannelWrongStateError, pika.exceptions.AMQPConnectionError):
             # при проблеме с каналом — реконнект и повторная публикация
@@ -93,122 +661,385 @@ class RpcClient:
             self.channel.basic_publish(
                 exchange='',
                 routing_key=queue_name,
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    reply_to      = self.callback_queue,
-                    correlation_id= self.correlation_id,
-                    delivery_mode = 2
-                )
+                body=rpc_codec.encode(message, REQUEST_CONTENT_TYPE),
+                properties=rpc_properties(queue_name, self.callback_queue, self.correlation_id)
             )
+        published = time.time()
+        RPC_PUBLISH.labels(queue_name).observe(published - started)
+        return published
+
+    def call(self, queue_name, message):
+        """Посылаем RPC‑запрос и ждём ответа (разобранного в dict)."""
+        properties, body = self.request(queue_name, message)
+        return rpc_codec.decode(body, properties.content_type)
+
+    def call_raw(self, queue_name, message):
+        """Как call, но возвращает (статус воркера, JSON-тело), см. reply_body."""
+        return reply_body(*self.request(queue_name, message))
+
+    def request(self, queue_name, message):
+        """Посылаем RPC‑запрос и ждём ответа: (properties, body) без разбора.
+
+        Ждём не дольше дедлайна очереди, потом RpcTimeout; опоздавший
+        ответ отбросит on_response по correlation_id.
+        """
+        published = self.publish(queue_name, message)
+        deadline  = published + deadline_for(queue_name)
 
         # ждём, пока on_response установит self.response
         while self.response is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                RPC_TIMEOUTS.labels(queue_name).inc()
+                raise RpcTimeout(f"No reply from {queue_name} in {deadline_for(queue_name)}s")
             try:
-                self.connection.process_data_events()
+                self.connection.process_data_events(time_limit=remaining)
             except pika.exceptions.AMQPConnectionError:
                 print("RabbitMQ lost, reconnecting…")
                 self.connect()
 
+        RPC_REPLY_WAIT.labels(queue_name).observe(time.time() - published)
         return self.response
 
-class RequestHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        start = time.time()
-        endpoint = self.path
-
-        length = int(self.headers.get('Content-Length', 0))
-        raw    = self.rfile.read(length) if length else b''
-        message= json.loads(raw) if raw else {}
+    def stream(self, queue_name, message):
+        """RPC с ответом из нескольких сообщений: генератор пар (kind, body).
 
-        client = get_rpc_client()
-        status = 500
-        resp   = None
+        kind — chunk (body — сырые байты куска), end или error (body — JSON).
+        Кредит за кусок уходит воркеру, когда генератор просят о следующем,
+        то есть после того, как кусок записан клиенту (см. server.StreamCredits).
+        """
+        published = self.publish(queue_name, message)
+        first = True
+        while True:
+            deadline = time.time() + deadline_for(queue_name)
+            while not self.stream_buffer:
+                if time.time() >= deadline:
+                    RPC_TIMEOUTS.labels(queue_name).inc()
+                    raise RpcTimeout(f"Stream from {queue_name} stalled for {deadline_for(queue_name)}s")
+                try:
+                    self.connection.process_data_events(time_limit=1)
+                except pika.exceptions.AMQPConnectionError:
+                    print("RabbitMQ lost during stream, reconnecting…")
+                    self.connect()
+                    raise ConnectionError("RabbitMQ connection lost during stream")
+            kind, body, credit_to = self.stream_buffer.popleft()
+            if first:
+                RPC_REPLY_WAIT.labels(queue_name).observe(time.time() - published)
+                first = False
+            yield kind, body
+            if kind != 'chunk':
+                return
+            if credit_to:
+                try:
+                    self.channel.basic_publish(exchange='', routing_key=credit_to, body=b'')
+                except pika.exceptions.AMQPError as e:
+                    raise ConnectionError(f"Failed to send stream credit: {e}")
 
-        if endpoint == '/api/register':
-            resp   = client.call(REGISTER_QUEUE, message)
-            status = 200 if resp.get('status') == 'success' else 401
+class RequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1: соединение (и поточный RpcClient) переживает запрос
+    protocol_version = 'HTTP/1.1'
+    timeout = HTTP_KEEPALIVE_TIMEOUT
 
-        elif endpoint == '/api/login':
-            if ENABLE_LATENCY_HACK:
-                time.sleep(0.6)
-            resp   = client.call(LOGIN_QUEUE, message)
-            status = 200 if resp.get('status') == 'success' else 401
+    def rpc(self, queue_name, message):
+        """Вызывает воркер: (статус воркера, JSON-тело, код ошибки или None).
 
-        elif endpoint == '/api/transaction':
-            resp   = client.call(TRANSACTION_QUEUE, message)
-            status = 200
+        Код ошибки — 503 при сбросе нагрузки и 504 по дедлайну.
+        """
+        if not SHEDDER.try_acquire(queue_name):
+            return 'failure', OVERLOADED_BODY, 503
+        try:
+            result, body = get_rpc_client().call_raw(queue_name, message)
+            return result, body, None
+        except RpcTimeout:
+            return 'failure', TIMEOUT_BODY, 504
+        finally:
+            SHEDDER.release()
 
-        else:
-            status = 404
+    def send_body(self, status, body):
+        """Отправляет ответ с готовым JSON-телом и возвращает status.
 
+        Content-Length есть всегда, поэтому соединение остаётся открытым для
+        следующего запроса (keep-alive). При 503 подсказывает, когда повторить.
+        """
+        body = body or b''
         self.send_response(status)
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', str(SHED_RETRY_AFTER))
+        elif status == 401:
+            self.send_header('WWW-Authenticate', 'Bearer')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
         self.end_headers()
-        if resp:
+        if body:
             try:
-                self.wfile.write(json.dumps(resp).encode())
+                self.wfile.write(body)
             except BrokenPipeError:
-                pass
+                self.close_connection = True
+        return status
 
-        LATENCY.labels('POST', endpoint).observe(time.time() - start)
-        REQUESTS.labels('POST', endpoint, status).inc()
+    def read_body_blocks(self):
+        """Читает тело по блокам: и с Content-Length, и с Transfer-Encoding: chunked."""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # trailer-заголовки до пустой строки
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                block = self.rfile.read(min(remaining, BULK_READ_BYTES))
+                if not block:
+                    return
+                remaining -= len(block)
+                yield block
 
-    def do_GET(self):
-        start    = time.time()
-        endpoint = self.path.split('?')[0]
+    def handle_bulk_import(self, user_id, query):
+        """POST /api/transactions/bulk?format=csv|ndjson.
 
-        if endpoint == '/metrics':
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(generate_latest())
-            return
+        Тело не читается целиком: строки режутся на куски по BULK_CHUNK_ROWS
+        и отправляются воркерам по мере чтения. Каждый кусок пишется
+        в своей транзакции, поэтому при сбое часть файла может быть уже сохранена.
+        """
+        # отказ до чтения тела: файл остаётся непрочитанным
+        if not bind_user(query, user_id):
+            self.skip_body()
+            return self.send_body(403, FORBIDDEN_BODY)
+        try:
+            fmt = bulk_format(query, self.headers.get('Content-Type'))
+        except ValueError as e:
+            self.skip_body()
+            return self.send_body(400, rpc_codec.dumps_json({'status': 'failure', 'error': f"Bad request: {e}"}))
+
+        if not SHEDDER.try_acquire(TRANSACTION_BULK_QUEUE):
+            self.skip_body()
+            return self.send_body(503, OVERLOADED_BODY)
+        try:
+            client  = get_rpc_client()
+            chunker = BulkChunker(user_id, fmt)
+            summary = BulkSummary()
+
+            def send(chunk):
+                try:
+                    summary.add(chunk, client.call(TRANSACTION_BULK_QUEUE, chunk))
+                except RpcTimeout:
+                    summary.add(chunk, {'status': 'failure', 'error': 'Backend timeout'})
+
+            for line in split_lines(self.read_body_blocks()):
+                if line is None:
+                    summary.reject(chunker.skip(), LINE_TOO_LONG)
+                    continue
+                chunk = chunker.feed(line)
+                if chunk:
+                    send(chunk)
+            chunk = chunker.take()
+            if chunk:
+                send(chunk)
+        finally:
+            SHEDDER.release()
+
+        resp = summary.result()
+        return self.send_body(200 if resp['status'] != 'failure' else 400, rpc_codec.dumps_json(resp))
 
-        if self.path.startswith('/api/transactions'):
-            params = dict(p.split('=') for p in self.path.split('?',1)[1].split('&'))
-            client = get_rpc_client()
-            resp   = client.call(TRANSACTION_GET_QUEUE, params)
-            status = 200
+    def handle_export(self, user_id, query):
+        """GET /api/transactions/export?format=csv|ndjson[&type=…].
+
+        Куски от воркера пишутся клиенту сразу, по мере прихода: для HTTP/1.1
+        с Transfer-Encoding: chunked, для HTTP/1.0 — до закрытия соединения.
+        Возвращает код ответа.
+        """
+        params = query
+        if not bind_user(params, user_id):
+            return self.send_body(403, FORBIDDEN_BODY)
+        fmt = params.get('format') or 'csv'
+        if fmt not in EXPORT_CONTENT_TYPES:
+            return self.send_body(400, rpc_codec.dumps_json({'status': 'failure', 'error': f"Unsupported format: {fmt}"}))
+
+        if not SHEDDER.try_acquire(TRANSACTION_EXPORT_QUEUE):
+            return self.send_body(503, OVERLOADED_BODY)
+        try:
+            return self.stream_export(fmt, params)
+        finally:
+            SHEDDER.release()
+
+    def stream_export(self, fmt, params):
+        stream = get_rpc_client().stream(TRANSACTION_EXPORT_QUEUE, params)
+        try:
+            kind, body = next(stream)
+        except ConnectionError:
+            kind, body, status = 'error', rpc_codec.dumps_json({'status': 'failure', 'error': 'Backend unavailable'}), 502
+        except RpcTimeout:
+            kind, body, status = 'error', TIMEOUT_BODY, 504
         else:
-            resp   = None
-            status = 404
+            status = 400
+        if kind == 'error':
+            self.send_body(status, body)
+            return status
 
-        self.send_response(status)
+        chunked = self.request_version == 'HTTP/1.1'
+        # обрыв посреди выгрузки не отличить от конца, поэтому соединение не переиспользуем
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', EXPORT_CONTENT_TYPES[fmt])
+        self.send_header('Content-Disposition', f'attachment; filename="transactions.{fmt}"')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
         self.end_headers()
-        if resp:
+
+        try:
+            while kind == 'chunk':
+                if body:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(body), body) if chunked else body)
+                kind, body = next(stream)
+            if kind == 'end' and chunked:
+                self.wfile.write(b'0\r\n\r\n')
+            elif kind == 'error':
+                # код уже отправлен: обрываем ответ без завершающего куска, клиент увидит неполное тело
+                print(f"Export failed mid-stream: {body!r}")
+        except (ConnectionError, RpcTimeout) as e:
+            # ушёл клиент, оборвался RabbitMQ или воркер замолчал; оставшиеся куски отбросит on_response
+            print(f"Export aborted: {e}")
+        return 200
+
+    def dispatch(self, method):
+        """Находит маршрут в ROUTES, проверяет токен и вызывает обработчик."""
+        start = time.time()
+        path, _, raw_query = self.path.partition('?')
+        name, endpoint, args = match_route(method, path)
+        if name is None:
+            self.skip_body()
+            status = self.send_body(404, None)
+        else:
             try:
-                self.wfile.write(json.dumps(resp).encode())
-            except BrokenPipeError:
-                pass
+                user_id = None
+                if endpoint not in PUBLIC_ENDPOINTS:
+                    user_id = authenticate(self.headers.get('Authorization'), endpoint in REVOKED_ENDPOINTS)
+                status = getattr(self, name)(user_id, dict(parse_qsl(raw_query)), *args)
+            except auth.InvalidToken:
+                self.skip_body()
+                status = self.send_body(401, UNAUTHORIZED_BODY)
+            except BadRequest as e:
+                status = self.send_body(400, e.body())
+        if endpoint != '/metrics':
+            LATENCY.labels(method, endpoint or 'unmatched').observe(time.time() - start)
+            REQUESTS.labels(method, endpoint or 'unmatched', status).inc()
 
-        LATENCY.labels('GET', endpoint).observe(time.time() - start)
-        REQUESTS.labels('GET', endpoint, status).inc()
+    def skip_body(self):
+        """Отвечаем, не читая тело: следующий запрос из этого соединения не разобрать, закрываем его."""
+        if self.headers.get('Transfer-Encoding') or self.headers.get('Content-Length', '0') != '0':
+            self.close_connection = True
 
-    def do_DELETE(self):
-        client = get_rpc_client()
+    def do_GET(self):
+        self.dispatch('GET')
 
-        if self.path.startswith('/api/user/'):
-            user_id = self.path.rsplit('/',1)[-1]
-            resp    = client.call(DELETE_USER_QUEUE, {'user_id': user_id})
-            status  = 200 if resp.get('status') == 'success' else 400
+    def do_POST(self):
+        self.dispatch('POST')
 
-        elif self.path.startswith('/api/transaction/'):
-            tx_id   = self.path.rsplit('/',1)[-1]
-            resp    = client.call(DELETE_TRANSACTION_QUEUE, {'transaction_id': tx_id})
-            status  = 200 if resp.get('status') == 'success' else 400
+    def do_DELETE(self):
+        self.dispatch('DELETE')
 
-        else:
-            resp   = None
-            status = 404
+    def read_json(self, endpoint):
+        """Тело запроса как dict; BadRequest, если его не разобрать (dispatch ответит 400)."""
+        start = time.time()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            # где кончается тело, неизвестно — следующий запрос из соединения не прочитать
+            self.close_connection = True
+            raise BadRequest("invalid Content-Length")
+        raw    = self.rfile.read(length) if length else b''
+        message= parse_json_body(raw)
+        PARSE_LATENCY.labels('POST', endpoint).observe(time.time() - start)
+        return message
 
-        self.send_response(status)
+    def handle_metrics(self, user_id, query):
+        self.send_response(200)
+        body = generate_latest()
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        if resp:
-            try:
-                self.wfile.write(json.dumps(resp).encode())
-            except BrokenPipeError:
-                pass
+        self.wfile.write(body)
+        return 200
+
+    def handle_register(self, user_id, query):
+        result, resp, error = self.rpc(REGISTER_QUEUE, self.read_json('/api/register'))
+        return self.send_body(error or (200 if result == 'success' else 401), resp)
+
+    def handle_login(self, user_id, query):
+        message = self.read_json('/api/login')
+        if ENABLE_LATENCY_HACK:
+            time.sleep(0.6)
+        result, resp, error = self.rpc(LOGIN_QUEUE, message)
+        status = error or (200 if result == 'success' else 401)
+        if status == 200:
+            resp = login_reply(resp)
+        return self.send_body(status, resp)
+
+    def handle_transaction(self, user_id, query):
+        message = self.read_json('/api/transaction')
+        try:
+            message['idempotency_key'] = idempotency_key(self.headers.get('Idempotency-Key'))
+        except ValueError as e:
+            return self.send_body(400, rpc_codec.dumps_json({'status': 'failure', 'error': str(e)}))
+        if not bind_user(message, user_id):
+            return self.send_body(403, FORBIDDEN_BODY)
+        _, resp, error = self.rpc(TRANSACTION_QUEUE, message)
+        return self.send_body(error or 200, resp)
+
+    def handle_transactions(self, user_id, query):
+        # type и параметры пагинации: limit, after_id, before, since;
+        # user_id берётся из токена, указанный в запросе должен с ним совпадать
+        if not bind_user(query, user_id):
+            return self.send_body(403, FORBIDDEN_BODY)
+        # одинаковые одновременные запросы списка идут к воркеру одним RPC
+        result, resp, error = READS.do(coalesce_key(TRANSACTION_GET_QUEUE, query),
+                                       lambda: self.rpc(TRANSACTION_GET_QUEUE, query))
+        return self.send_body(error or (200 if result == 'success' else 400), resp)
+
+    def handle_summary(self, user_id, query):
+        # period=day|month, необязательные from/to
+        if not bind_user(query, user_id):
+            return self.send_body(403, FORBIDDEN_BODY)
+        result, resp, error = self.rpc(SUMMARY_QUEUE, query)
+        return self.send_body(error or (200 if result == 'success' else 400), resp)
+
+    def handle_deletion_status(self, user_id, query, path_user_id):
+        # состояние фонового удаления: pending | running | done | failed
+        if not bind_user({'user_id': path_user_id}, user_id):
+            return self.send_body(403, FORBIDDEN_BODY)
+        result, resp, error = self.rpc(USER_DELETION_STATUS_QUEUE, {'user_id': user_id})
+        return self.send_body(error or (200 if result == 'success' else 404), resp)
+
+    def handle_delete_user(self, user_id, query, path_user_id):
+        if not bind_user({'user_id': path_user_id}, user_id):
+            return self.send_body(403, FORBIDDEN_BODY)
+        result, resp, error = self.rpc(DELETE_USER_QUEUE, {'user_id': user_id})
+        if result == 'success' and not error:
+            REVOKED_USERS.add(user_id)
+        # данные стираются в фоне, ход удаления — GET /api/user/{id}/deletion
+        return self.send_body(error or (202 if result == 'success' else 400), resp)
+
+    def handle_delete_transaction(self, user_id, query, transaction_id):
+        # необязательный created_at сужает поиск до одной месячной секции;
+        # user_id не даёт удалить чужую транзакцию
+        message = {'transaction_id': transaction_id, 'user_id': user_id, 'created_at': query.get('created_at')}
+        result, resp, error = self.rpc(DELETE_TRANSACTION_QUEUE, message)
+        return self.send_body(error or (200 if result == 'success' else 400), resp)
 
 def run(server_class=ThreadingHTTPServer, handler_class=RequestHandler, port=8000):
     start_http_server(8001)
+    SHEDDER.start_monitor()
+    REVOKED_USERS.start()
     print("Prometheus on :8001, API Gateway on :8000")
     server = server_class(('', port), handler_class)
     server.serve_forever()
@@ -0,0 +1,625 @@
+import asyncio
+import itertools
+import os
+import time
+import uuid
+
+import auth
+import pika
+import rpc_codec
+from aiohttp import web
+from pika.adapters.asyncio_connection import AsyncioConnection
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest, start_http_server
+
+from api_gateway import (
+    BULK_READ_BYTES,
+    DELETE_TRANSACTION_QUEUE,
+    DELETE_USER_QUEUE,
+    ENABLE_LATENCY_HACK,
+    EXPORT_CONTENT_TYPES,
+    FORBIDDEN_BODY,
+    LATENCY,
+    LINE_TOO_LONG,
+    LOGIN_QUEUE,
+    OVERLOADED_BODY,
+    PARSE_LATENCY,
+    PUBLIC_ENDPOINTS,
+    RABBITMQ_HOST,
+    REGISTER_QUEUE,
+    REQUESTS,
+    REQUEST_CONTENT_TYPE,
+    REVOKED_ENDPOINTS,
+    REVOKED_USERS,
+    ROUTES,
+    RPC_COALESCED,
+    RPC_PUBLISH,
+    RPC_REPLY_WAIT,
+    RPC_TIMEOUTS,
+    SHEDDER,
+    SHED_RETRY_AFTER,
+    STREAM_MAX_BUFFER,
+    STREAM_OVERFLOW_BODY,
+    SUMMARY_QUEUE,
+    TIMEOUT_BODY,
+    TRANSACTION_BULK_QUEUE,
+    TRANSACTION_EXPORT_QUEUE,
+    TRANSACTION_GET_QUEUE,
+    TRANSACTION_QUEUE,
+    UNAUTHORIZED_BODY,
+    USER_DELETION_STATUS_QUEUE,
+    BadRequest,
+    BulkChunker,
+    BulkSummary,
+    LineSplitter,
+    RpcTimeout,
+    authenticate,
+    bind_user,
+    bulk_format,
+    coalesce_key,
+    deadline_for,
+    idempotency_key,
+    login_reply,
+    parse_json_body,
+    reply_body,
+    rpc_properties,
+)
+
+# Число AMQP-соединений, между которыми распределяются запросы (обычно хватает одного)
+RPC_CONNECTIONS = int(os.environ.get('RPC_CONNECTIONS', 1))
+# Сколько при старте ждать RabbitMQ; дальше шлюз принимает запросы и отвечает 504, пока не подключится
+RPC_CONNECT_TIMEOUT = float(os.environ.get('RPC_CONNECT_TIMEOUT', 30))
+# Сколько кусков одного массового импорта обрабатываются воркерами одновременно
+BULK_MAX_IN_FLIGHT = int(os.environ.get('BULK_MAX_IN_FLIGHT', 4))
+
+
+class AsyncRpcClient:
+    """Одно AMQP-соединение и одна reply-очередь на все запросы.
+
+    Ответы сопоставляются с ожидающими корутинами по correlation_id,
+    поэтому одновременный запрос стоит future, а не поток с соединением.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._connection = None
+        self._channel = None
+        self._callback_queue = None
+        self._futures = {}
+        self._streams = {}
+        self._ready = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        self._connect()
+        try:
+            await asyncio.wait_for(self._ready.wait(), RPC_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            # переподключение продолжается в фоне, запросы ждут его в счёт своего таймаута
+            print(f"RabbitMQ not connected in {RPC_CONNECT_TIMEOUT}s, starting anyway")
+
+    def _connect(self):
+        params = pika.ConnectionParameters(
+            host=RABBITMQ_HOST,
+            heartbeat=120,
+            blocked_connection_timeout=600
+        )
+        self._connection = AsyncioConnection(
+            params,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self._loop
+        )
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        print(f"RabbitMQ connect failed ({error}), retrying in 5s…")
+        self._loop.call_later(5, self._connect)
+
+    def _on_connection_closed(self, connection, reason):
+        self._ready.clear()
+        self._channel = None
+        # ответы на уже отправленные запросы пришли бы в удалённую exclusive-очередь
+        self._fail_pending(ConnectionError(f"RabbitMQ connection closed: {reason}"))
+        print("RabbitMQ lost, reconnecting…")
+        self._loop.call_later(1, self._connect)
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.queue_declare(queue='', exclusive=True, callback=self._on_queue_declared)
+
+    def _on_queue_declared(self, frame):
+        self._callback_queue = frame.method.queue
+        self._channel.basic_consume(
+            queue=self._callback_queue,
+            on_message_callback=self._on_response,
+            auto_ack=True
+        )
+        print("RabbitMQ connected.")
+        self._ready.set()
+
+    def _on_response(self, ch, method, properties, body):
+        headers = properties.headers or {}
+        kind = headers.get('x-stream')
+        if kind is not None:
+            queue = self._streams.get(properties.correlation_id)
+            if queue is None:
+                return
+            if queue.full():
+                # воркер не ждёт кредитов: обрываем поток, а не копим его в памяти
+                self._abort_stream(properties.correlation_id, STREAM_OVERFLOW_BODY)
+            else:
+                queue.put_nowait((kind, body, headers.get('x-credit-to')))
+            return
+        future = self._futures.pop(properties.correlation_id, None)
+        if future is not None and not future.done():
+            future.set_result((properties, body))
+
+    def _fail_pending(self, exc):
+        futures, self._futures = self._futures, {}
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(exc)
+        for correlation_id in list(self._streams):
+            self._abort_stream(correlation_id, rpc_codec.dumps_json({'status': 'failure', 'error': str(exc)}))
+
+    def _abort_stream(self, correlation_id, body):
+        """Заменяет непрочитанные сообщения потока ошибкой; остальные его сообщения отбрасываются."""
+        queue = self._streams.pop(correlation_id)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(('error', body, None))
+
+    async def _wait_ready(self, queue_name, timeout):
+        """Ждёт соединения с RabbitMQ в счёт timeout запроса; возвращает остаток timeout.
+
+        Пока идёт переподключение, запрос держит место в SHEDDER, поэтому
+        ждать без срока нельзя: RpcTimeout по истечении превращается в 504.
+        """
+        if self._ready.is_set():
+            return timeout
+        started = time.time()
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            RPC_TIMEOUTS.labels(queue_name).inc()
+            raise RpcTimeout(f"RabbitMQ unavailable, {queue_name} not sent in {timeout}s")
+        return max(timeout - (time.time() - started), 0)
+
+    def _publish(self, queue_name, message, correlation_id):
+        started = time.time()
+        self._channel.basic_publish(
+            exchange='',
+            routing_key=queue_name,
+            body=rpc_codec.encode(message, REQUEST_CONTENT_TYPE),
+            properties=rpc_properties(queue_name, self._callback_queue, correlation_id)
+        )
+        published = time.time()
+        RPC_PUBLISH.labels(queue_name).observe(published - started)
+        return published
+
+    async def call(self, queue_name, message, timeout=None):
+        """Посылаем RPC-запрос и ждём ответа (разобранного в dict)."""
+        properties, body = await self.request(queue_name, message, timeout)
+        return rpc_codec.decode(body, properties.content_type)
+
+    async def call_raw(self, queue_name, message, timeout=None):
+        """Как call, но возвращает (статус воркера, JSON-тело), см. reply_body."""
+        return reply_body(*await self.request(queue_name, message, timeout))
+
+    async def request(self, queue_name, message, timeout=None):
+        """Посылаем RPC-запрос и ждём (properties, body) не дольше timeout секунд.
+
+        По умолчанию timeout — дедлайн очереди, тот же, что уходит воркеру в x-deadline.
+        """
+        timeout = timeout or deadline_for(queue_name)
+        remaining = await self._wait_ready(queue_name, timeout)
+        correlation_id = str(uuid.uuid4())
+        future = self._loop.create_future()
+        self._futures[correlation_id] = future
+        try:
+            published = self._publish(queue_name, message, correlation_id)
+            response = await asyncio.wait_for(future, remaining)
+            RPC_REPLY_WAIT.labels(queue_name).observe(time.time() - published)
+            return response
+        except asyncio.TimeoutError:
+            RPC_TIMEOUTS.labels(queue_name).inc()
+            raise RpcTimeout(f"No reply from {queue_name} in {timeout}s")
+        finally:
+            self._futures.pop(correlation_id, None)
+
+    async def stream(self, queue_name, message, timeout=None):
+        """RPC с ответом из нескольких сообщений: асинхронный генератор (kind, body).
+
+        kind — chunk, end или error, как в RpcClient.stream; timeout
+        ограничивает ожидание каждого следующего сообщения. Кредит за кусок
+        уходит воркеру, когда просят следующий, то есть после записи клиенту,
+        поэтому в очереди не больше STREAM_WINDOW воркера кусков.
+        """
+        timeout = timeout or deadline_for(queue_name)
+        await self._wait_ready(queue_name, timeout)
+        correlation_id = str(uuid.uuid4())
+        queue = asyncio.Queue(maxsize=STREAM_MAX_BUFFER)
+        self._streams[correlation_id] = queue
+        try:
+            published = self._publish(queue_name, message, correlation_id)
+            first = True
+            while True:
+                try:
+                    kind, body, credit_to = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    RPC_TIMEOUTS.labels(queue_name).inc()
+                    raise RpcTimeout(f"Stream from {queue_name} stalled for {timeout}s")
+                if first:
+                    RPC_REPLY_WAIT.labels(queue_name).observe(time.time() - published)
+                    first = False
+                yield kind, body
+                if kind != 'chunk':
+                    return
+                if credit_to:
+                    if self._channel is None:
+                        raise ConnectionError("RabbitMQ connection lost during stream")
+                    self._channel.basic_publish(exchange='', routing_key=credit_to, body=b'')
+        finally:
+            self._streams.pop(correlation_id, None)
+
+
+class RpcClientPool:
+    """Небольшой пул AsyncRpcClient с выдачей по кругу."""
+
+    def __init__(self, size):
+        self._clients = [AsyncRpcClient() for _ in range(size)]
+        self._cycle = itertools.cycle(self._clients)
+
+    async def start(self):
+        await asyncio.gather(*(client.start() for client in self._clients))
+
+    def call(self, queue_name, message, timeout=None):
+        return next(self._cycle).call(queue_name, message, timeout)
+
+    def call_raw(self, queue_name, message, timeout=None):
+        return next(self._cycle).call_raw(queue_name, message, timeout)
+
+    def stream(self, queue_name, message, timeout=None):
+        return next(self._cycle).stream(queue_name, message, timeout)
+
+
+class AsyncSingleFlight:
+    """SingleFlight для корутин: одинаковые одновременные вызовы ждут одну задачу."""
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, factory):
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda done: self.calls.pop(key, None) if self.calls.get(key) is done else None)
+        else:
+            RPC_COALESCED.labels(key[0]).inc()
+        # ушедший клиент первого запроса не должен отменять вызов для остальных
+        return await asyncio.shield(task)
+
+
+READS = AsyncSingleFlight()
+
+
+def endpoint_of(request):
+    """Шаблон маршрута (метка endpoint в метриках) или None, если маршрута нет."""
+    route = request.match_info.route
+    return route.resource.canonical if route.resource is not None else None
+
+
+def json_response(status, resp):
+    body = rpc_codec.dumps_json(resp) if resp else None
+    return raw_response(status, body)
+
+
+def raw_response(status, body):
+    """Ответ с уже закодированным JSON-телом; при 503 подсказывает, когда повторить."""
+    headers = {'Retry-After': str(SHED_RETRY_AFTER)} if status == 503 else (
+        {'WWW-Authenticate': 'Bearer'} if status == 401 else None)
+    return web.Response(status=status, body=body, headers=headers,
+                        content_type='application/json' if body else None)
+
+
+async def rpc(request, queue_name, message, shed=True):
+    """Вызывает воркер и возвращает (ответ, код ошибки).
+
+    Код выставляется при сбросе нагрузки (503), таймауте (504) или обрыве (502);
+    shed=False — для запросов, место под которые уже занято в SHEDDER.
+    """
+    if shed and not SHEDDER.try_acquire(queue_name):
+        return rpc_codec.loads_json(OVERLOADED_BODY), 503
+    try:
+        return await request.app['rpc'].call(queue_name, message), None
+    except RpcTimeout:
+        return rpc_codec.loads_json(TIMEOUT_BODY), 504
+    except ConnectionError:
+        return {'status': 'failure', 'error': 'Backend unavailable'}, 502
+    finally:
+        if shed:
+            SHEDDER.release()
+
+
+async def rpc_raw(request, queue_name, message):
+    """Как rpc, но без разбора ответа: (статус воркера, JSON-тело, код ошибки)."""
+    if not SHEDDER.try_acquire(queue_name):
+        return 'failure', OVERLOADED_BODY, 503
+    try:
+        result, body = await request.app['rpc'].call_raw(queue_name, message)
+        return result, body, None
+    except RpcTimeout:
+        return 'failure', TIMEOUT_BODY, 504
+    except ConnectionError:
+        return 'failure', rpc_codec.dumps_json({'status': 'failure', 'error': 'Backend unavailable'}), 502
+    finally:
+        SHEDDER.release()
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = time.time()
+    endpoint = endpoint_of(request) or 'unmatched'
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if endpoint != '/metrics':
+            LATENCY.labels(request.method, endpoint).observe(time.time() - start)
+            REQUESTS.labels(request.method, endpoint, status).inc()
+    return response
+
+
+@web.middleware
+async def auth_middleware(request, handler):
+    """Проверяет токен сессии и кладёт user_id его владельца в request['user_id']."""
+    endpoint = endpoint_of(request)
+    # без маршрута обработчик всё равно ответит 404
+    if endpoint is not None and endpoint not in PUBLIC_ENDPOINTS:
+        try:
+            request['user_id'] = authenticate(request.headers.get('Authorization'), endpoint in REVOKED_ENDPOINTS)
+        except auth.InvalidToken:
+            return raw_response(401, UNAUTHORIZED_BODY)
+    return await handler(request)
+
+
+async def handle_bulk_import(request):
+    """POST /api/transactions/bulk: тело читается потоком и уходит воркерам кусками.
+
+    Одновременно в работе не больше BULK_MAX_IN_FLIGHT кусков, так что
+    чтение следующей части файла идёт параллельно с записью предыдущих.
+    """
+    user_id = request['user_id']
+    if not bind_user(dict(request.query), user_id):
+        return raw_response(403, FORBIDDEN_BODY)
+    try:
+        fmt = bulk_format(request.query, request.content_type)
+    except ValueError as e:
+        return json_response(400, {'status': 'failure', 'error': f"Bad request: {e}"})
+
+    # один импорт занимает одно место в SHEDDER, сколько бы кусков ни было в работе
+    if not SHEDDER.try_acquire(TRANSACTION_BULK_QUEUE):
+        return raw_response(503, OVERLOADED_BODY)
+    try:
+        return await bulk_import(request, fmt, user_id)
+    finally:
+        SHEDDER.release()
+
+
+async def bulk_import(request, fmt, user_id):
+    chunker = BulkChunker(user_id, fmt)
+    summary = BulkSummary()
+    window = asyncio.Semaphore(BULK_MAX_IN_FLIGHT)
+    pending = set()
+
+    async def send(chunk):
+        try:
+            resp, _ = await rpc(request, TRANSACTION_BULK_QUEUE, chunk, shed=False)
+            summary.add(chunk, resp)
+        finally:
+            window.release()
+
+    async def submit(chunk):
+        await window.acquire()
+        task = asyncio.ensure_future(send(chunk))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    async def feed(lines):
+        for line in lines:
+            if line is None:
+                summary.reject(chunker.skip(), LINE_TOO_LONG)
+                continue
+            chunk = chunker.feed(line)
+            if chunk:
+                await submit(chunk)
+
+    splitter = LineSplitter()
+    async for block in request.content.iter_chunked(BULK_READ_BYTES):
+        await feed(splitter.feed(block))
+    await feed(splitter.close())
+    chunk = chunker.take()
+    if chunk:
+        await submit(chunk)
+    await asyncio.gather(*pending)
+
+    resp = summary.result()
+    return json_response(200 if resp['status'] != 'failure' else 400, resp)
+
+
+async def read_json(request):
+    """Тело запроса как dict; неразборчивое тело — ответ 400."""
+    start = time.time()
+    raw = await request.read()
+    try:
+        message = parse_json_body(raw)
+    except BadRequest as e:
+        raise web.HTTPBadRequest(body=e.body(), content_type='application/json')
+    PARSE_LATENCY.labels('POST', endpoint_of(request)).observe(time.time() - start)
+    return message
+
+
+async def handle_register(request):
+    result, body, error = await rpc_raw(request, REGISTER_QUEUE, await read_json(request))
+    return raw_response(error or (200 if result == 'success' else 401), body)
+
+
+async def handle_login(request):
+    message = await read_json(request)
+    if ENABLE_LATENCY_HACK:
+        await asyncio.sleep(0.6)
+    result, body, error = await rpc_raw(request, LOGIN_QUEUE, message)
+    status = error or (200 if result == 'success' else 401)
+    if status == 200:
+        body = login_reply(body)
+    return raw_response(status, body)
+
+
+async def handle_transaction(request):
+    message = await read_json(request)
+    try:
+        message['idempotency_key'] = idempotency_key(request.headers.get('Idempotency-Key'))
+    except ValueError as e:
+        return json_response(400, {'status': 'failure', 'error': str(e)})
+    if not bind_user(message, request['user_id']):
+        return raw_response(403, FORBIDDEN_BODY)
+    _, body, error = await rpc_raw(request, TRANSACTION_QUEUE, message)
+    return raw_response(error or 200, body)
+
+
+async def handle_export(request):
+    """GET /api/transactions/export: куски от воркера уходят клиенту через chunked-ответ."""
+    params = dict(request.query)
+    if not bind_user(params, request['user_id']):
+        return raw_response(403, FORBIDDEN_BODY)
+    fmt = params.get('format') or 'csv'
+    if fmt not in EXPORT_CONTENT_TYPES:
+        return json_response(400, {'status': 'failure', 'error': f"Unsupported format: {fmt}"})
+
+    if not SHEDDER.try_acquire(TRANSACTION_EXPORT_QUEUE):
+        return raw_response(503, OVERLOADED_BODY)
+    try:
+        return await stream_export(request, fmt, params)
+    finally:
+        SHEDDER.release()
+
+
+async def stream_export(request, fmt, params):
+    stream = request.app['rpc'].stream(TRANSACTION_EXPORT_QUEUE, params)
+    try:
+        kind, body = await stream.__anext__()
+    except RpcTimeout:
+        return raw_response(504, TIMEOUT_BODY)
+    except ConnectionError:
+        return json_response(502, {'status': 'failure', 'error': 'Backend unavailable'})
+    if kind == 'error':
+        await stream.aclose()
+        return raw_response(400, body)
+
+    response = web.StreamResponse(headers={
+        'Content-Type': EXPORT_CONTENT_TYPES[fmt],
+        'Content-Disposition': f'attachment; filename="transactions.{fmt}"',
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    try:
+        while kind == 'chunk':
+            if body:
+                await response.write(body)
+            kind, body = await stream.__anext__()
+    except (RpcTimeout, ConnectionError) as e:
+        kind, body = 'error', str(e)
+    finally:
+        await stream.aclose()
+    if kind == 'error':
+        # код уже отправлен: обрываем соединение без завершающего куска, клиент увидит неполное тело
+        print(f"Export failed mid-stream: {body!r}")
+        if request.transport is not None:
+            request.transport.close()
+        return response
+    await response.write_eof()
+    return response
+
+
+async def handle_metrics(request):
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+async def handle_transactions(request):
+    # user_id берётся из токена; указанный в запросе должен с ним совпадать
+    params = dict(request.query)
+    if not bind_user(params, request['user_id']):
+        return raw_response(403, FORBIDDEN_BODY)
+    # одинаковые одновременные запросы списка идут к воркеру одним RPC
+    result, body, error = await READS.do(coalesce_key(TRANSACTION_GET_QUEUE, params),
+                                         lambda: rpc_raw(request, TRANSACTION_GET_QUEUE, params))
+    return raw_response(error or (200 if result == 'success' else 400), body)
+
+
+async def handle_summary(request):
+    params = dict(request.query)
+    if not bind_user(params, request['user_id']):
+        return raw_response(403, FORBIDDEN_BODY)
+    result, body, error = await rpc_raw(request, SUMMARY_QUEUE, params)
+    return raw_response(error or (200 if result == 'success' else 400), body)
+
+
+async def handle_deletion_status(request):
+    user_id = request['user_id']
+    if not bind_user({'user_id': request.match_info['user_id']}, user_id):
+        return raw_response(403, FORBIDDEN_BODY)
+    result, body, error = await rpc_raw(request, USER_DELETION_STATUS_QUEUE, {'user_id': user_id})
+    return raw_response(error or (200 if result == 'success' else 404), body)
+
+
+async def handle_delete_user(request):
+    user_id = request['user_id']
+    if not bind_user({'user_id': request.match_info['user_id']}, user_id):
+        return raw_response(403, FORBIDDEN_BODY)
+    result, body, error = await rpc_raw(request, DELETE_USER_QUEUE, {'user_id': user_id})
+    if result == 'success' and not error:
+        REVOKED_USERS.add(user_id)
+    return raw_response(error or (202 if result == 'success' else 400), body)
+
+
+async def handle_delete_transaction(request):
+    message = {'transaction_id': request.match_info['transaction_id'], 'user_id': request['user_id'],
+               'created_at': request.query.get('created_at')}
+    result, body, error = await rpc_raw(request, DELETE_TRANSACTION_QUEUE, message)
+    return raw_response(error or (200 if result == 'success' else 400), body)
+
+
+async def on_startup(app):
+    app['rpc'] = RpcClientPool(RPC_CONNECTIONS)
+    await app['rpc'].start()
+    SHEDDER.start_monitor()
+    # опрос удалённых пользователей идёт в своём потоке на блокирующем клиенте
+    REVOKED_USERS.start()
+
+
+def make_app():
+    app = web.Application(middlewares=[metrics_middleware, auth_middleware])
+    # маршруты общие с api_gateway; {param} в шаблонах — синтаксис и aiohttp
+    handlers = globals()
+    for method, template, name in ROUTES:
+        app.router.add_route(method, template, handlers[name])
+    app.on_startup.append(on_startup)
+    return app
+
+
+def run(port=8000):
+    start_http_server(8001)
+    print("Prometheus on :8001, async API Gateway on :8000")
+    web.run_app(make_app(), port=port, print=None)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,78 @@
+"""Токены сессии: шлюз выдаёт их на /api/login и проверяет сам, без RPC и БД.
+
+Токен — "<kid>.<user_id>.<expires_at>.<подпись>", где подпись — HMAC-SHA256
+первых трёх полей ключом kid из AUTH_KEYS ("kid:секрет,kid2:секрет2").
+Новые токены подписываются ключом AUTH_ACTIVE_KEY, проверяются — любым
+из AUTH_KEYS. Ротация: добавить новый ключ в AUTH_KEYS, сделать его
+активным, а старый убрать не раньше чем через AUTH_TOKEN_TTL секунд.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+
+class InvalidToken(Exception):
+    """Токен отсутствует, испорчен, подписан неизвестным ключом или истёк."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def parse_keys(raw):
+    keys = {}
+    for item in filter(None, (part.strip() for part in raw.split(','))):
+        kid, _, secret = item.partition(':')
+        kid = kid.strip()
+        if not kid or '.' in kid or not secret:
+            raise ValueError(f"Bad AUTH_KEYS entry: {kid!r}")
+        keys[kid] = secret.strip().encode()
+    return keys
+
+
+AUTH_KEYS = parse_keys(os.environ.get('AUTH_KEYS', ''))
+if not AUTH_KEYS:
+    # токены перестанут проходить проверку после перезапуска шлюза
+    print("AUTH_KEYS is not set, signing session tokens with a random key")
+    AUTH_KEYS = {'local': secrets.token_bytes(32)}
+AUTH_ACTIVE_KEY = os.environ.get('AUTH_ACTIVE_KEY') or next(iter(AUTH_KEYS))
+if AUTH_ACTIVE_KEY not in AUTH_KEYS:
+    raise ValueError(f"AUTH_ACTIVE_KEY {AUTH_ACTIVE_KEY!r} is missing from AUTH_KEYS")
+AUTH_TOKEN_TTL = int(os.environ.get('AUTH_TOKEN_TTL', 12 * 3600))
+
+
+def _sign(key, payload):
+    digest = hmac.new(key, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def issue_token(user_id, ttl=AUTH_TOKEN_TTL):
+    """(токен, unix-время истечения) для user_id."""
+    expires_at = int(time.time()) + ttl
+    payload = f"{AUTH_ACTIVE_KEY}.{int(user_id)}.{expires_at}"
+    return f"{payload}.{_sign(AUTH_KEYS[AUTH_ACTIVE_KEY], payload)}", expires_at
+
+
+def verify_token(token):
+    """user_id из токена; InvalidToken, если он не прошёл проверку."""
+    if not token.isascii():
+        # compare_digest не сравнивает не-ASCII строки, а годный токен из них не состоит
+        raise InvalidToken('malformed')
+    payload, _, signature = token.rpartition('.')
+    kid, _, claims = payload.partition('.')
+    key = AUTH_KEYS.get(kid)
+    if key is None:
+        raise InvalidToken('unknown_key')
+    if not hmac.compare_digest(_sign(key, payload), signature):
+        raise InvalidToken('bad_signature')
+    user_id, _, expires_at = claims.partition('.')
+    try:
+        user_id, expires_at = int(user_id), int(expires_at)
+    except ValueError:
+        raise InvalidToken('malformed')
+    if expires_at <= time.time():
+        raise InvalidToken('expired')
+    return user_id
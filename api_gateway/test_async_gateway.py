@@ -0,0 +1,126 @@
+"""Проверки шлюза на aiohttp без RabbitMQ: RPC подменяется заглушкой.
+
+Запуск из каталога api_gateway: python -m unittest
+"""
+import unittest
+
+import auth
+import rpc_codec
+from aiohttp.test_utils import TestClient, TestServer
+
+import async_gateway
+from api_gateway import (
+    BULK_MAX_LINE_BYTES,
+    DELETE_USER_QUEUE,
+    LINE_TOO_LONG,
+    REVOKED_USERS,
+    USER_DELETION_STATUS_QUEUE,
+)
+
+
+class FakeRpc:
+    """Отвечает успехом на удаление и статусом pending на запрос хода удаления."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def call_raw(self, queue_name, message, timeout=None):
+        self.calls.append((queue_name, message))
+        if queue_name == DELETE_USER_QUEUE:
+            return 'success', rpc_codec.dumps_json({'status': 'success', 'deletion': 'pending'})
+        if queue_name == USER_DELETION_STATUS_QUEUE:
+            return 'success', rpc_codec.dumps_json({'status': 'success', 'state': 'pending'})
+        return 'success', rpc_codec.dumps_json({'status': 'success'})
+
+    async def call(self, queue_name, message, timeout=None):
+        self.calls.append((queue_name, message))
+        return {'status': 'success', 'inserted': len(message.get('lines', [])), 'rejected': 0, 'errors': []}
+
+
+class AuthTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        app = async_gateway.make_app()
+        app.on_startup.clear()
+        app['rpc'] = self.rpc = FakeRpc()
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        self.user_id = 424242
+        token, _ = auth.issue_token(self.user_id)
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def test_deletion_status_after_delete(self):
+        resp = await self.client.delete(f'/api/user/{self.user_id}', headers=self.headers)
+        self.assertEqual(resp.status, 202)
+        self.assertIn(self.user_id, REVOKED_USERS)
+
+        # ход удаления виден по тому же токену
+        resp = await self.client.get(f'/api/user/{self.user_id}/deletion', headers=self.headers)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual((await resp.json())['state'], 'pending')
+        self.assertEqual(self.rpc.calls[-1], (USER_DELETION_STATUS_QUEUE, {'user_id': self.user_id}))
+
+        # а на остальные маршруты — уже нет
+        resp = await self.client.get('/api/summary', headers=self.headers)
+        self.assertEqual(resp.status, 401)
+
+    async def test_non_ascii_signature(self):
+        token, _ = auth.issue_token(self.user_id)
+        token = token[:-1] + 'é'
+        resp = await self.client.get('/api/summary', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(resp.status, 401)
+
+
+
+class JsonBodyTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        app = async_gateway.make_app()
+        app.on_startup.clear()
+        app['rpc'] = FakeRpc()
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def test_bad_bodies(self):
+        for body in (b'{bad', b'[]', b'"x"', b'\xff'):
+            resp = await self.client.post('/api/register', data=body)
+            self.assertEqual(resp.status, 400, body)
+            self.assertEqual((await resp.json())['status'], 'failure')
+
+
+
+class BulkImportTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        app = async_gateway.make_app()
+        app.on_startup.clear()
+        app['rpc'] = self.rpc = FakeRpc()
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        token, _ = auth.issue_token(7)
+        self.headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'text/csv'}
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def test_overlong_line_is_rejected(self):
+        body = (b'type,category,amount\n'
+                b'income,salary,10\n'
+                + b'x' * (3 * BULK_MAX_LINE_BYTES) + b'\n'
+                b'expense,food,5')
+        resp = await self.client.post('/api/transactions/bulk', data=body, headers=self.headers)
+        self.assertEqual(resp.status, 200)
+        result = await resp.json()
+        self.assertEqual((result['inserted'], result['rejected']), (2, 1))
+        self.assertEqual(result['errors'], [{'line': 3, 'error': LINE_TOO_LONG}])
+        self.assertEqual(self.rpc.calls[-1][1]['lines'], ['income,salary,10', 'expense,food,5'])
+
+
+if __name__ == '__main__':
+    unittest.main()
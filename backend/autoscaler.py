@@ -0,0 +1,193 @@
+"""Супервизор пулов воркеров: держит в каждом пуле от min до max процессов.
+
+Раз в AUTOSCALE_INTERVAL секунд смотрит, сколько готовых сообщений ждёт
+в очередях пула (passive queue_declare). Если на процесс приходится больше
+AUTOSCALE_TARGET_BACKLOG, пул сразу растёт до нужного размера; если
+очереди почти пусты (меньше AUTOSCALE_IDLE_BACKLOG на процесс) дольше
+AUTOSCALE_DOWN_DELAY секунд — уменьшается на один процесс. Лишний процесс
+получает SIGTERM и дорабатывает уже взятые сообщения (см. server.start_worker);
+не завершившийся за WORKER_SHUTDOWN_TIMEOUT убивается. Упавшие процессы
+заменяются на следующем шаге.
+"""
+import math
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import pika
+
+import metrics
+from metrics import WORKER_CRASHES, WORKER_POOL_BACKLOG, WORKER_POOL_SCALE_EVENTS, WORKER_POOL_SIZE
+
+
+RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
+AUTOSCALE_INTERVAL = float(os.environ.get('AUTOSCALE_INTERVAL', 5))
+AUTOSCALE_TARGET_BACKLOG = int(os.environ.get('AUTOSCALE_TARGET_BACKLOG', 50))
+AUTOSCALE_IDLE_BACKLOG = int(os.environ.get('AUTOSCALE_IDLE_BACKLOG', 5))
+AUTOSCALE_DOWN_DELAY = float(os.environ.get('AUTOSCALE_DOWN_DELAY', 60))
+# Новым процессам нужно время, чтобы подключиться и начать разбирать очередь
+AUTOSCALE_UP_COOLDOWN = float(os.environ.get('AUTOSCALE_UP_COOLDOWN', 15))
+# Сколько воркер дорабатывает взятые сообщения после SIGTERM
+WORKER_SHUTDOWN_TIMEOUT = float(os.environ.get('WORKER_SHUTDOWN_TIMEOUT', 30))
+
+
+class WorkerPool:
+    """Процессы, потребляющие один набор очередей."""
+
+    def __init__(self, name, queues, min_size, max_size, target):
+        self.name = name
+        self.queues = queues
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target = target
+        self.processes = []  # работающие, в порядке запуска
+        self.draining = []   # (процесс, срок): получили SIGTERM и дорабатывают
+        self.idle_since = None
+        self.scaled_up_at = 0.0
+
+    @property
+    def size(self):
+        return len(self.processes)
+
+    def spawn(self):
+        p = multiprocessing.Process(target=self.target, args=(self.queues,), name=f"worker[{self.name}]")
+        p.start()
+        self.processes.append(p)
+
+    def retire(self):
+        """Останавливает самый новый процесс пула."""
+        p = self.processes.pop()
+        p.terminate()
+        # воркер сам выходит через WORKER_SHUTDOWN_TIMEOUT; запас — на закрытие соединений
+        self.draining.append((p, time.time() + WORKER_SHUTDOWN_TIMEOUT + 5))
+
+    def reap(self):
+        """Убирает завершившиеся процессы; возвращает число упавших среди работающих.
+
+        Зависшие после SIGTERM дольше срока процессы убиваются и
+        убираются на одном из следующих шагов.
+        """
+        now = time.time()
+        for p, deadline in self.draining:
+            if p.is_alive() and now >= deadline:
+                print(f"Worker {p.pid} of pool {self.name} did not stop in time, killing it")
+                p.kill()
+        crashed = [p for p in self.processes if not p.is_alive()]
+        for p in crashed + [p for p, _ in self.draining if not p.is_alive()]:
+            p.join()
+            metrics.mark_worker_dead(p.pid)
+            print(f"Worker {p.pid} of pool {self.name} exited with code {p.exitcode}")
+        self.processes = [p for p in self.processes if p.is_alive()]
+        self.draining = [(p, deadline) for p, deadline in self.draining if p.is_alive()]
+        return len(crashed)
+
+    def desired_size(self, backlog, now):
+        """Сколько процессов нужно пулу, если в его очередях ждут backlog сообщений."""
+        size = max(self.size, 1)
+        desired = self.size
+        if backlog > AUTOSCALE_TARGET_BACKLOG * size:
+            self.idle_since = None
+            if now - self.scaled_up_at >= AUTOSCALE_UP_COOLDOWN:
+                desired = math.ceil(backlog / AUTOSCALE_TARGET_BACKLOG)
+        elif backlog < AUTOSCALE_IDLE_BACKLOG * size:
+            if self.idle_since is None:
+                self.idle_since = now
+            elif now - self.idle_since >= AUTOSCALE_DOWN_DELAY:
+                # следующий шаг вниз — не раньше чем через AUTOSCALE_DOWN_DELAY
+                self.idle_since = now
+                desired = self.size - 1
+        else:
+            self.idle_since = None
+        return min(self.max_size, max(self.min_size, desired))
+
+
+class Supervisor:
+    """Главный процесс бэкенда: запускает пулы и меняет их размер по глубине очередей."""
+
+    def __init__(self, target, pools):
+        self.pools = [WorkerPool(name, queues, min_size, max_size, target)
+                      for name, queues, min_size, max_size in pools]
+        self.stopped = threading.Event()
+        self.connection = None
+        self.channel = None
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for pool in self.pools:
+            for _ in range(pool.min_size):
+                pool.spawn()
+            WORKER_POOL_SIZE.labels(pool.name).set(pool.size)
+        while not self.stopped.wait(AUTOSCALE_INTERVAL):
+            self.step()
+        self.shutdown()
+
+    def stop(self, signum, frame):
+        self.stopped.set()
+
+    def step(self):
+        now = time.time()
+        for pool in self.pools:
+            crashed = pool.reap()
+            if crashed:
+                WORKER_CRASHES.labels(pool.name).inc(crashed)
+            backlog = self.backlog(pool.queues)
+            if backlog is None:
+                # без RabbitMQ размер не меняем, только возвращаем упавшие процессы
+                target = max(pool.size + crashed, pool.min_size)
+            else:
+                WORKER_POOL_BACKLOG.labels(pool.name).set(backlog)
+                target = pool.desired_size(backlog, now)
+                if crashed:
+                    target = max(target, min(pool.size + crashed, pool.max_size))
+
+            if target > pool.size:
+                print(f"Pool {pool.name}: {pool.size} -> {target} workers (backlog {backlog})")
+                WORKER_POOL_SCALE_EVENTS.labels(pool.name, 'up').inc()
+                pool.scaled_up_at = now
+                while pool.size < target:
+                    pool.spawn()
+            elif target < pool.size:
+                print(f"Pool {pool.name}: {pool.size} -> {target} workers (backlog {backlog})")
+                WORKER_POOL_SCALE_EVENTS.labels(pool.name, 'down').inc()
+                while pool.size > target:
+                    pool.retire()
+            WORKER_POOL_SIZE.labels(pool.name).set(pool.size)
+
+    def backlog(self, queues):
+        """Готовые сообщения в очередях пула или None, если RabbitMQ недоступен."""
+        try:
+            if self.channel is None or self.channel.is_closed:
+                self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+                self.channel = self.connection.channel()
+            total = 0
+            for queue in queues:
+                try:
+                    total += self.channel.queue_declare(queue=queue, passive=True).method.message_count
+                except pika.exceptions.ChannelClosedByBroker:
+                    # очередь ещё не объявлена воркерами
+                    self.channel = self.connection.channel()
+            return total
+        except pika.exceptions.AMQPError as e:
+            print(f"Autoscaler lost RabbitMQ ({e})")
+            self.connection = self.channel = None
+            return None
+
+    def shutdown(self):
+        """Останавливает все пулы, давая воркерам доработать взятые сообщения."""
+        print("Stopping workers…")
+        for pool in self.pools:
+            while pool.processes:
+                pool.retire()
+        for pool in self.pools:
+            for p, deadline in pool.draining:
+                p.join(max(0.0, deadline - time.time()))
+                if p.is_alive():
+                    print(f"Worker {p.pid} did not stop in time, killing it")
+                    p.kill()
+                    p.join()
+                metrics.mark_worker_dead(p.pid)
+            pool.draining = []
+            WORKER_POOL_SIZE.labels(pool.name).set(0)
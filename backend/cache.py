@@ -0,0 +1,112 @@
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_EVICTIONS, CACHE_HITS, CACHE_MISSES
+
+
+# redis — общий кеш для всех воркеров, none — выключен, memory — LRU в памяти
+# процесса. Инвалидация после записи в memory видна только записавшему процессу,
+# поэтому этот режим годится лишь для одного процесса-воркера (см. server.py).
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'none')
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 30))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
+
+
+class LRUCache:
+    """Ограниченный по размеру LRU-кеш с TTL, потокобезопасный."""
+
+    def __init__(self, name, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                CACHE_HITS.labels(self.name).inc()
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+        CACHE_MISSES.labels(self.name).inc()
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                CACHE_EVICTIONS.labels(self.name).inc()
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SharedCache:
+    """Кеш поверх внешнего хранилища, общего для всех воркеров и контейнеров.
+
+    client — любой объект с get/set(ex=)/delete в духе redis.Redis,
+    так что в локальном окружении его можно подменить, например, fakeredis.
+    Вытеснением управляет само хранилище (maxmemory-policy), поэтому
+    счётчик evictions здесь не растёт.
+    """
+
+    def __init__(self, name, client, ttl=CACHE_TTL):
+        self.name = name
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        raw = self.client.get(f"{self.name}:{key}")
+        if raw is None:
+            CACHE_MISSES.labels(self.name).inc()
+            return None
+        CACHE_HITS.labels(self.name).inc()
+        return pickle.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(f"{self.name}:{key}", pickle.dumps(value), ex=max(1, int(self.ttl)))
+
+    def delete(self, key):
+        self.client.delete(f"{self.name}:{key}")
+
+
+class NullCache:
+    """Кеш-заглушка: всегда промах."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+_redis_client = None
+
+
+def make_cache(name, backend=CACHE_BACKEND):
+    """Создаёт кеш выбранного в CACHE_BACKEND типа."""
+    global _redis_client
+    if backend == 'none':
+        return NullCache(name)
+    if backend == 'redis':
+        if _redis_client is None:
+            import redis
+            _redis_client = redis.Redis.from_url(REDIS_URL)
+        return SharedCache(name, _redis_client)
+    return LRUCache(name)
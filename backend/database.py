@@ -1,12 +1,76 @@
 import psycopg2
-from psycopg2 import OperationalError
+from psycopg2 import IntegrityError, InterfaceError, OperationalError
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import wraps
+import csv
+import inspect
+import io
 import os
+import threading
+import time
 
+import cache
+from metrics import DB_POOL_CHECKOUTS, DB_POOL_IN_USE, DB_POOL_RECONNECTS, DB_POOL_WAIT, DB_QUERY_SECONDS
+
+
+DB_HOST = os.environ.get('DB_HOST', 'db')
+DB_PORT = int(os.environ.get('DB_PORT', 5432))
+DB_NAME = os.environ.get('DB_NAME', 'finance_db')
+DB_USER = os.environ.get('DB_USER', 'user')
+DB_PASSWORD = os.environ.get('DB_PASSWORD', 'password')
+
+# Пул создаётся отдельно в каждом процессе-воркере
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 4))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+# Соединение, простоявшее дольше этого времени, проверяется через SELECT 1 перед выдачей
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', 30))
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# Произвольный ключ advisory-lock, чтобы миграции не накатывали несколько контейнеров сразу
+MIGRATIONS_LOCK_ID = 7215001
+
+# Размер страницы GET /api/transactions по умолчанию и верхняя граница
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+SUMMARY_PERIODS = ('day', 'month')
+
+# Повторы регистрации при транзиентных ошибках БД
+REGISTER_RETRIES = int(os.environ.get('REGISTER_RETRIES', 3))
+REGISTER_RETRY_BACKOFF = float(os.environ.get('REGISTER_RETRY_BACKOFF', 0.05))
+
+# Строк в одной выборке из серверного курсора при выгрузке транзакций
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 2000))
+
+# Фоновое удаление пользователя: транзакций за одну пачку и пауза между пачками
+USER_PURGE_BATCH_SIZE = int(os.environ.get('USER_PURGE_BATCH_SIZE', 1000))
+USER_PURGE_THROTTLE_MS = int(os.environ.get('USER_PURGE_THROTTLE_MS', 50))
+# Сколько раз подряд пачка может откатиться без прогресса, прежде чем очистка считается упавшей
+USER_PURGE_MAX_STALLS = int(os.environ.get('USER_PURGE_MAX_STALLS', 5))
+
+# Ключи идемпотентности записи транзакций: сколько хранить в базе и сколько
+# последних держать в памяти процесса, чтобы повтор не доходил до БД
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+IDEMPOTENCY_CACHE_ENTRIES = int(os.environ.get('IDEMPOTENCY_CACHE_ENTRIES', 10000))
+IDEMPOTENCY_CACHE_TTL = float(os.environ.get('IDEMPOTENCY_CACHE_TTL', 600))
+
+# Сколько разных страниц одного списка (user_id, type) держать в кеше
+CACHE_MAX_PAGES = int(os.environ.get('CACHE_MAX_PAGES', 8))
+
+# Read-through кеши: списки транзакций по (user_id, type) и учётные данные по логину.
+# Инвалидируются после коммита пишущих функций ниже — во всех процессах только
+# с общим CACHE_BACKEND=redis; с memory воркер может быть лишь один (см. server.py).
+# Чтение, начатое до коммита, может успеть положить устаревшую страницу —
+# её срок жизни ограничен CACHE_TTL.
+transactions_cache = cache.make_cache('transactions')
+logins_cache = cache.make_cache('logins')
+# (user_id, ключ) -> transaction_id; всегда в памяти: ключ записан в базе, кеш только срезает повторы
+idempotency_cache = cache.LRUCache('idempotency_keys', IDEMPOTENCY_CACHE_ENTRIES, IDEMPOTENCY_CACHE_TTL)
 
-DB_HOST = 'db'
-DB_NAME = 'finance_db'
-DB_USER = 'user'
-DB_PASSWORD = 'password'
 
 def get_db_connection():
     """Создает и возвращает соединение с базой данных."""
@@ -16,85 +80,750 @@ def get_db_connection():
             user=DB_USER,
             password=DB_PASSWORD,
             host=DB_HOST,
-            port=5432
+            port=DB_PORT
         )
         return conn
     except OperationalError as e:
         print(f"Ошибка подключения к базе данных: {e}")
-        return None
+        raise
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с ожиданием свободного слота и health-check."""
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_interval):
+        self._pool = ThreadedConnectionPool(
+            minconn, maxconn,
+            dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT
+        )
+        # ThreadedConnectionPool при исчерпании сразу бросает PoolError,
+        # семафор превращает это в ожидание с таймаутом
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+        self._healthcheck_interval = healthcheck_interval
+        self._last_used = {}
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolError(f"Нет свободных соединений в пуле за {self._timeout}s")
+        try:
+            conn = self._checkout_healthy()
+        except Exception:
+            self._slots.release()
+            raise
+        DB_POOL_WAIT.observe(time.monotonic() - started)
+        DB_POOL_CHECKOUTS.inc()
+        DB_POOL_IN_USE.inc()
+        return conn
+
+    def putconn(self, conn, close=False):
+        close = close or bool(conn.closed)
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            DB_POOL_IN_USE.dec()
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def _checkout_healthy(self):
+        conn = self._pool.getconn()
+        if conn.closed:
+            return self._replace(conn)
+        idle = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle > self._healthcheck_interval:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                conn.rollback()
+            except (OperationalError, InterfaceError):
+                return self._replace(conn)
+        return conn
+
+    def _replace(self, conn):
+        """Выбрасывает сломанное соединение и открывает новое на его месте."""
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+        DB_POOL_RECONNECTS.inc()
+        return self._pool.getconn()
 
-def create_user(username, password):
-    """Регистрирует нового пользователя в базе данных."""
+
+def run_migrations():
+    """Накатывает ещё не применённые SQL-файлы из migrations/ по порядку имён.
+
+    Вызывается в главном процессе до запуска воркеров, поэтому работает
+    через отдельное соединение, а не через пул.
+    """
     conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s) RETURNING id;", (username, password))
-        user_id = cursor.fetchone()[0]
-        conn.commit()
-        return user_id
-    except psycopg2.IntegrityError as e:
-        conn.rollback()
-        if 'unique_username' in str(e):
-            raise ValueError("Логин уже занят. Выберите другой.")
-        else:
-            raise e
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s);", (MIGRATIONS_LOCK_ID,))
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                " name TEXT PRIMARY KEY,"
+                " applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);"
+            )
+            conn.commit()
+            cursor.execute("SELECT name FROM schema_migrations;")
+            applied = {row[0] for row in cursor.fetchall()}
+
+            for name in sorted(os.listdir(MIGRATIONS_DIR)):
+                if not name.endswith('.sql') or name in applied:
+                    continue
+                with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                    cursor.execute(f.read())
+                cursor.execute("INSERT INTO schema_migrations (name) VALUES (%s);", (name,))
+                conn.commit()
+                print(f"Migration {name} applied.")
+
+            cursor.execute("SELECT pg_advisory_unlock(%s);", (MIGRATIONS_LOCK_ID,))
+            conn.commit()
     finally:
-        cursor.close()
         conn.close()
 
-def authenticate_user(username, password):
-    """Проверяет пользователя и его пароль."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users WHERE username = %s AND password = %s;", (username, password))
-    user_id = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return user_id[0] if user_id else None
-
-def add_transaction(user_id, transaction_type, category, amount):
-    """Добавляет транзакцию в базу данных."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO transactions (user_id, type, category, amount) VALUES (%s, %s, %s, %s) RETURNING id;",
-                   (user_id, transaction_type, category, amount))
-    transaction_id = cursor.fetchone()[0]
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return transaction_id
-
-def get_transactions(user_id, transaction_type):
-    """Получает список транзакций для пользователя."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, category, amount, created_at FROM transactions WHERE user_id = %s AND type = %s;",
-        (user_id, transaction_type)
-    )
-    transactions = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [{'id': tx[0], 'category': tx[1], 'amount': tx[2], 'created_at': tx[3]} for tx in transactions]
 
-def delete_transaction(transaction_id):
-    """Удаляет транзакцию из базы данных."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM transactions WHERE id = %s;", (transaction_id,))
-    conn.commit()
-    cursor.close()
-    conn.close()
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
 
-def delete_user(user_id):
-    """Удаляет пользователя и его данные из базы."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
+def get_pool():
+    """Возвращает пул текущего процесса, создавая его при первом обращении.
+
+    Соединения нельзя наследовать через fork, поэтому пул привязан к PID.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_INTERVAL)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+@contextmanager
+def pooled_connection(query_name='other'):
+    """Берёт соединение из пула и возвращает его обратно (разорванное — закрывает).
+
+    Время от получения соединения до возврата пишется в db_query_seconds
+    с меткой query_name: ожидание пула и попадания в кеш туда не входят.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    started = time.monotonic()
+    broken = False
     try:
-        cursor.execute("DELETE FROM transactions WHERE user_id = %s;", (user_id,))
-        cursor.execute("DELETE FROM users WHERE id = %s;", (user_id,))
-        conn.commit()
+        yield conn
+    except (OperationalError, InterfaceError):
+        broken = True
+        raise
     finally:
-        cursor.close()
-        conn.close()
+        DB_QUERY_SECONDS.labels(query_name).observe(time.monotonic() - started)
+        # незакоммиченная транзакция откатывается самим пулом при возврате
+        pool.putconn(conn, close=broken)
+
+
+def retry_on_disconnect(func):
+    """Повторяет вызов один раз, если соединение с БД оборвалось посреди запроса.
+
+    Только для чтений и идемпотентных записей: обрыв после COMMIT не отличить
+    от обрыва до него, и повтор простого INSERT вставил бы строку второй раз.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as e:
+            print(f"Соединение с БД потеряно ({e}), переподключаемся…")
+            DB_POOL_RECONNECTS.inc()
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def retry_on_disconnect_with_keys(param):
+    """retry_on_disconnect для вставок: повтор, только если у всех строк есть ключ идемпотентности.
+
+    param — аргумент с ключом (или списком ключей). Повтор с ключами вернёт
+    id уже записанных строк вместо вставки дублей.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        retrying = retry_on_disconnect(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            keys = signature.bind(*args, **kwargs).arguments.get(param)
+            if isinstance(keys, (list, tuple)):
+                keyed = bool(keys) and all(key is not None for key in keys)
+            else:
+                keyed = keys is not None
+            return (retrying if keyed else func)(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def create_user(username, password_hash):
+    """Регистрирует нового пользователя в базе данных.
+
+    Один запрос: INSERT ... ON CONFLICT DO NOTHING плюс существующая строка
+    с тем же логином. Возвращает (user_id, создан ли, сохранённый хеш):
+    при занятом логине транзакция не откатывается, а вызывающий может
+    проверить пароль по хешу и ответить на повтор той же регистрации
+    уже созданным id. Транзиентные ошибки (обрыв соединения,
+    serialization failure) повторяются до REGISTER_RETRIES раз
+    с экспоненциальной паузой. Повтор после потерянного COMMIT не создаёт
+    второго пользователя: логин уникален, и повтор получает уже созданную строку.
+    """
+    for attempt in range(REGISTER_RETRIES):
+        try:
+            with pooled_connection('create_user') as conn, conn.cursor() as cursor:
+                cursor.execute(
+                    "WITH inserted AS ("
+                    " INSERT INTO users (username, password) VALUES (%s, %s)"
+                    " ON CONFLICT (username) DO NOTHING RETURNING id, password)"
+                    " SELECT id, true, password FROM inserted"
+                    " UNION ALL"
+                    " SELECT id, false, password FROM users WHERE username = %s AND deleted_at IS NULL"
+                    " LIMIT 1;",
+                    (username, password_hash, username)
+                )
+                row = cursor.fetchone()
+                conn.commit()
+            break
+        except OperationalError as e:
+            if attempt == REGISTER_RETRIES - 1:
+                raise
+            print(f"Transient error registering {username} ({e}), retrying…")
+            time.sleep(REGISTER_RETRY_BACKOFF * 2 ** attempt)
+
+    if row is None:
+        # логин занят параллельной регистрацией, которую снимок запроса ещё не видит
+        raise ValueError("Логин уже занят. Выберите другой.")
+    return tuple(row)
+
+
+def lock_active_users(cursor, user_ids):
+    """Блокирует строки пользователей до конца транзакции; ValueError, если кто-то удалён.
+
+    FOR SHARE конфликтует с UPDATE из mark_user_deleted: пометка дождётся
+    коммита этой записи (и очистка её сотрёт), а запись, начатая после
+    пометки, увидит deleted_at и не пройдёт.
+    """
+    user_ids = {int(user_id) for user_id in user_ids}
+    cursor.execute("SELECT id FROM users WHERE id IN %s AND deleted_at IS NULL FOR SHARE;", (tuple(user_ids),))
+    missing = user_ids - {row[0] for row in cursor.fetchall()}
+    if missing:
+        raise ValueError(f"Пользователь удалён или не существует: {', '.join(map(str, sorted(missing)))}")
+
+
+def transactions_cache_key(user_id, transaction_type):
+    return f"{user_id}:{transaction_type}"
+
+
+def invalidate_transactions(keys):
+    """Сбрасывает закешированные списки для пар (user_id, type)."""
+    for user_id, transaction_type in set(keys):
+        transactions_cache.delete(transactions_cache_key(user_id, transaction_type))
+
+
+@retry_on_disconnect
+def get_credentials(username):
+    """Возвращает (user_id, хеш пароля) по логину или None."""
+    credentials = logins_cache.get(username)
+    if credentials is None:
+        with pooled_connection('get_credentials') as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT id, password FROM users WHERE username = %s AND deleted_at IS NULL;", (username,))
+            credentials = cursor.fetchone()
+        if credentials is None:
+            return None
+        credentials = tuple(credentials)
+        logins_cache.set(username, credentials)
+    return credentials
+
+
+@retry_on_disconnect
+def update_password_hash(user_id, username, password_hash):
+    """Сохраняет пересчитанный хеш пароля (миграция со старого формата)."""
+    with pooled_connection('update_password_hash') as conn, conn.cursor() as cursor:
+        cursor.execute("UPDATE users SET password = %s WHERE id = %s;", (password_hash, user_id))
+        conn.commit()
+    logins_cache.delete(username)
+
+
+# Столбцы, которые INSERT/DELETE возвращают для пересчёта предагрегатов
+ROLLUP_RETURNING = "RETURNING id, user_id, type, category, amount, created_at"
+
+
+def apply_rollups(cursor, rows, sign=1):
+    """Прибавляет (sign=1) или вычитает (sign=-1) транзакции из предагрегатов.
+
+    rows — строки вида ROLLUP_RETURNING. Вызывается в той же транзакции,
+    что и изменение transactions. Ключи сортируются, чтобы параллельные
+    пачки брали блокировки строк в одном порядке.
+    """
+    by_category = {}
+    by_day = {}
+    for _, user_id, transaction_type, category, amount, created_at in rows:
+        if user_id is None:
+            continue
+        key = (user_id, transaction_type, category)
+        total, count = by_category.get(key, (0, 0))
+        by_category[key] = (total + sign * amount, count + sign)
+        if created_at is None:
+            continue
+        key = (user_id, transaction_type, created_at.date())
+        total, count = by_day.get(key, (0, 0))
+        by_day[key] = (total + sign * amount, count + sign)
+
+    if by_category:
+        execute_values(
+            cursor,
+            "INSERT INTO user_category_totals AS t (user_id, type, category, total, tx_count) VALUES %s "
+            "ON CONFLICT (user_id, type, category) DO UPDATE "
+            "SET total = t.total + EXCLUDED.total, tx_count = t.tx_count + EXCLUDED.tx_count;",
+            [key + value for key, value in sorted(by_category.items())]
+        )
+    if by_day:
+        execute_values(
+            cursor,
+            "INSERT INTO user_daily_totals AS t (user_id, type, day, total, tx_count) VALUES %s "
+            "ON CONFLICT (user_id, type, day) DO UPDATE "
+            "SET total = t.total + EXCLUDED.total, tx_count = t.tx_count + EXCLUDED.tx_count;",
+            [key + value for key, value in sorted(by_day.items())]
+        )
+
+
+def idempotency_cache_key(user_id, key):
+    return f"{user_id}:{key}"
+
+
+@retry_on_disconnect_with_keys('idempotency_key')
+def add_transaction(user_id, transaction_type, category, amount, idempotency_key=None):
+    """Добавляет транзакцию в базу данных.
+
+    С idempotency_key повторный вызов с тем же ключом возвращает id уже
+    созданной транзакции и ничего не пишет. Ключ вставляется в той же
+    транзакции, что и строка; при конфликте (включая одновременный повтор —
+    его INSERT дождётся коммита первого) всё откатывается. Удалённому
+    пользователю запись не добавляется (ValueError, см. lock_active_users).
+    """
+    if idempotency_key is not None:
+        transaction_id = idempotency_cache.get(idempotency_cache_key(user_id, idempotency_key))
+        if transaction_id is not None:
+            return transaction_id
+
+    with pooled_connection('add_transaction') as conn, conn.cursor() as cursor:
+        lock_active_users(cursor, [user_id])
+        cursor.execute("INSERT INTO transactions (user_id, type, category, amount) VALUES (%s, %s, %s, %s) "
+                       + ROLLUP_RETURNING + ";",
+                       (user_id, transaction_type, category, amount))
+        row = cursor.fetchone()
+        if idempotency_key is not None:
+            cursor.execute(
+                "INSERT INTO transaction_idempotency_keys (user_id, key, transaction_id) VALUES (%s, %s, %s) "
+                "ON CONFLICT DO NOTHING;",
+                (user_id, idempotency_key, row[0])
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                cursor.execute("SELECT transaction_id FROM transaction_idempotency_keys "
+                               "WHERE user_id = %s AND key = %s;", (user_id, idempotency_key))
+                transaction_id = cursor.fetchone()[0]
+                conn.commit()
+                idempotency_cache.set(idempotency_cache_key(user_id, idempotency_key), transaction_id)
+                return transaction_id
+        apply_rollups(cursor, [row])
+        conn.commit()
+    invalidate_transactions([(user_id, transaction_type)])
+    if idempotency_key is not None:
+        idempotency_cache.set(idempotency_cache_key(user_id, idempotency_key), row[0])
+    return row[0]
+
+
+@retry_on_disconnect_with_keys('idempotency_keys')
+def add_transactions_batch(rows, idempotency_keys=None):
+    """Добавляет пачку транзакций одним INSERT и одним коммитом.
+
+    rows — список кортежей (user_id, type, category, amount);
+    возвращает id транзакций в том же порядке. idempotency_keys — ключи
+    (или None) для каждой строки: строки с уже записанным ключом, в том
+    числе повторы внутри пачки, не вставляются и получают id прежней
+    транзакции. Если ключ одновременно записал другой воркер, пачка
+    откатывается с IntegrityError и её стоит повторить по одной строке.
+    Пачка с удалённым пользователем не пишется целиком (ValueError).
+    """
+    keys = idempotency_keys or [None] * len(rows)
+    transaction_ids = [None] * len(rows)
+    # (user_id, ключ) -> номера строк с этим ключом
+    keyed = {}
+    for i, (row, key) in enumerate(zip(rows, keys)):
+        if key is None:
+            continue
+        cached = idempotency_cache.get(idempotency_cache_key(row[0], key))
+        if cached is not None:
+            transaction_ids[i] = cached
+        else:
+            keyed.setdefault((int(row[0]), key), []).append(i)
+
+    with pooled_connection('add_transactions_batch') as conn, conn.cursor() as cursor:
+        lock_active_users(cursor, [row[0] for row in rows])
+        if keyed:
+            cursor.execute("SELECT user_id, key, transaction_id FROM transaction_idempotency_keys "
+                           "WHERE (user_id, key) IN %s;", (tuple(keyed),))
+            for user_id, key, transaction_id in cursor.fetchall():
+                for i in keyed.pop((user_id, key)):
+                    transaction_ids[i] = transaction_id
+        # первая строка каждого нового ключа вставляется, остальные с тем же ключом получат её id
+        fresh = [i for i in range(len(rows)) if transaction_ids[i] is None and keys[i] is None]
+        fresh += [indexes[0] for indexes in keyed.values()]
+        fresh.sort()
+
+        result = []
+        if fresh:
+            # page_size не меньше длины пачки, иначе execute_values разобьёт её на несколько INSERT;
+            # RETURNING одиночного INSERT ... VALUES отдаёт строки в порядке VALUES
+            result = execute_values(
+                cursor,
+                "INSERT INTO transactions (user_id, type, category, amount) VALUES %s " + ROLLUP_RETURNING + ";",
+                [rows[i] for i in fresh],
+                page_size=len(fresh),
+                fetch=True
+            )
+            for i, row in zip(fresh, result):
+                transaction_ids[i] = row[0]
+        if keyed:
+            for indexes in keyed.values():
+                for i in indexes[1:]:
+                    transaction_ids[i] = transaction_ids[indexes[0]]
+            inserted = execute_values(
+                cursor,
+                "INSERT INTO transaction_idempotency_keys (user_id, key, transaction_id) VALUES %s "
+                "ON CONFLICT DO NOTHING RETURNING key;",
+                [(user_id, key, transaction_ids[indexes[0]]) for (user_id, key), indexes in keyed.items()],
+                page_size=len(keyed),
+                fetch=True
+            )
+            if len(inserted) < len(keyed):
+                conn.rollback()
+                raise IntegrityError("Idempotency key was written concurrently")
+        apply_rollups(cursor, result)
+        conn.commit()
+    invalidate_transactions((row[1], row[2]) for row in result)
+    for (user_id, key), indexes in keyed.items():
+        idempotency_cache.set(idempotency_cache_key(user_id, key), transaction_ids[indexes[0]])
+    return transaction_ids
+
+
+def purge_idempotency_keys(max_age_hours=IDEMPOTENCY_KEY_TTL_HOURS):
+    """Удаляет ключи идемпотентности старше max_age_hours; возвращает их число."""
+    with pooled_connection('purge_idempotency_keys') as conn, conn.cursor() as cursor:
+        cursor.execute("DELETE FROM transaction_idempotency_keys "
+                       "WHERE created_at < CURRENT_TIMESTAMP - %s * interval '1 hour';", (max_age_hours,))
+        conn.commit()
+        return cursor.rowcount
+
+
+def import_transactions(user_id, rows):
+    """Массово загружает уже проверенные строки через COPY.
+
+    rows — список кортежей (type, category, amount, created_at или None).
+    Строки копируются во временную таблицу сессии, затем одним
+    INSERT ... SELECT переносятся в transactions вместе с пересчётом
+    предагрегатов; всё в одной транзакции. Возвращает число вставленных строк;
+    удалённому пользователю ничего не пишется (ValueError).
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for transaction_type, category, amount, created_at in rows:
+        writer.writerow([transaction_type, category, amount, created_at.isoformat() if created_at else ''])
+    buffer.seek(0)
+
+    with pooled_connection('import_transactions') as conn, conn.cursor() as cursor:
+        lock_active_users(cursor, [user_id])
+        # соединение из пула живёт долго, поэтому временная таблица создаётся один раз на сессию
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS bulk_transactions ("
+            " type TEXT, category TEXT, amount NUMERIC, created_at TIMESTAMP"
+            ") ON COMMIT DELETE ROWS;"
+        )
+        cursor.copy_expert(
+            "COPY bulk_transactions (type, category, amount, created_at) FROM STDIN WITH (FORMAT csv);",
+            buffer
+        )
+        cursor.execute(
+            "INSERT INTO transactions (user_id, type, category, amount, created_at) "
+            "SELECT %s, type, category, amount, COALESCE(created_at, CURRENT_TIMESTAMP) "
+            "FROM bulk_transactions " + ROLLUP_RETURNING + ";",
+            (user_id,)
+        )
+        inserted = cursor.fetchall()
+        apply_rollups(cursor, inserted)
+        conn.commit()
+    invalidate_transactions((row[1], row[2]) for row in inserted)
+    return len(inserted)
+
+
+def page_size(limit=None):
+    """Приводит запрошенный размер страницы к допустимому диапазону."""
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+@retry_on_disconnect
+def get_transactions(user_id, transaction_type, limit=DEFAULT_PAGE_SIZE, after_id=None, before=None, since=None):
+    """Получает страницу транзакций пользователя в порядке возрастания id.
+
+    Keyset-пагинация: after_id — id последней транзакции предыдущей
+    страницы, since/before — границы created_at. Обе выборки идут по
+    индексам (user_id, type, ...), поэтому не зависят от длины истории.
+    Границы по created_at вдобавок отсекают лишние месячные секции.
+    """
+    limit = page_size(limit)
+    key = transactions_cache_key(user_id, transaction_type)
+    page_key = (limit, after_id, before, since)
+    pages = transactions_cache.get(key) or {}
+    if page_key in pages:
+        return pages[page_key]
+
+    query = "SELECT id, category, amount, created_at FROM transactions WHERE user_id = %s AND type = %s"
+    params = [user_id, transaction_type]
+    if after_id is not None:
+        query += " AND id > %s"
+        params.append(int(after_id))
+    if before is not None:
+        query += " AND created_at < %s"
+        params.append(before)
+    if since is not None:
+        query += " AND created_at >= %s"
+        params.append(since)
+    query += " ORDER BY id LIMIT %s;"
+    params.append(limit)
+
+    with pooled_connection('get_transactions') as conn, conn.cursor() as cursor:
+        cursor.execute(query, params)
+        transactions = cursor.fetchall()
+    result = [{'id': tx[0], 'category': tx[1], 'amount': tx[2], 'created_at': tx[3]} for tx in transactions]
+    if len(pages) < CACHE_MAX_PAGES:
+        transactions_cache.set(key, {**pages, page_key: result})
+    return result
+
+
+def export_transactions(user_id, transaction_type=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Генератор пачек строк (id, type, category, amount, created_at) по возрастанию id.
+
+    Выборка держится именованным (серверным) курсором, так что в памяти
+    воркера одновременно не больше chunk_rows строк при любой длине истории.
+    Соединение из пула занято, пока генератор не исчерпан или не закрыт.
+    """
+    query = "SELECT id, type, category, amount, created_at FROM transactions WHERE user_id = %s"
+    params = [user_id]
+    if transaction_type is not None:
+        query += " AND type = %s"
+        params.append(transaction_type)
+    query += " ORDER BY id;"
+
+    with pooled_connection('export_transactions') as conn:
+        with conn.cursor(name=f"export_{user_id}_{threading.get_ident()}") as cursor:
+            cursor.itersize = chunk_rows
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield rows
+        conn.rollback()
+
+
+@retry_on_disconnect
+def get_summary(user_id, period='month', date_from=None, date_to=None):
+    """Сводка по предагрегатам: итоги по типам и категориям и разбивка по дням/месяцам.
+
+    date_from/date_to (включительно) ограничивают только разбивку по периодам.
+    """
+    if period not in SUMMARY_PERIODS:
+        raise ValueError(f"period должен быть одним из: {', '.join(SUMMARY_PERIODS)}")
+
+    bucket_query = (
+        "SELECT type, date_trunc(%s, day)::date AS period_start, sum(total), sum(tx_count) "
+        "FROM user_daily_totals WHERE user_id = %s AND tx_count > 0"
+    )
+    bucket_params = [period, user_id]
+    if date_from is not None:
+        bucket_query += " AND day >= %s"
+        bucket_params.append(date_from)
+    if date_to is not None:
+        bucket_query += " AND day <= %s"
+        bucket_params.append(date_to)
+    bucket_query += " GROUP BY type, period_start ORDER BY period_start, type;"
+
+    with pooled_connection('get_summary') as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT type, category, total, tx_count FROM user_category_totals "
+            "WHERE user_id = %s AND tx_count > 0 ORDER BY type, category;",
+            (user_id,)
+        )
+        categories = cursor.fetchall()
+        cursor.execute(bucket_query, bucket_params)
+        buckets = cursor.fetchall()
+
+    totals = {'income': Decimal(0), 'expense': Decimal(0)}
+    for transaction_type, _, total, _ in categories:
+        totals[transaction_type] = totals.get(transaction_type, Decimal(0)) + total
+    return {
+        'totals': totals,
+        'balance': totals['income'] - totals['expense'],
+        'categories': [
+            {'type': row[0], 'category': row[1], 'total': row[2], 'count': row[3]} for row in categories
+        ],
+        'period': period,
+        'buckets': [
+            {'type': row[0], 'period_start': row[1], 'total': row[2], 'count': row[3]} for row in buckets
+        ],
+    }
+
+
+@retry_on_disconnect
+def delete_transaction(transaction_id, created_at=None, user_id=None):
+    """Удаляет транзакцию из базы данных.
+
+    created_at (если клиент его знает) позволяет планировщику искать
+    только в одной месячной секции, а не в индексах всех. С user_id
+    удаляется только транзакция этого пользователя.
+    """
+    query = "DELETE FROM transactions WHERE id = %s"
+    params = [transaction_id]
+    if user_id is not None:
+        query += " AND user_id = %s"
+        params.append(user_id)
+    if created_at is not None:
+        query += " AND created_at = %s"
+        params.append(created_at)
+    with pooled_connection('delete_transaction') as conn, conn.cursor() as cursor:
+        cursor.execute(query + " " + ROLLUP_RETURNING + ";", params)
+        deleted = cursor.fetchall()
+        apply_rollups(cursor, deleted, sign=-1)
+        conn.commit()
+    invalidate_transactions((row[1], row[2]) for row in deleted)
+
+
+DELETION_JOB_COLUMNS = ('user_id', 'status', 'deleted_rows', 'error', 'created_at', 'finished_at')
+
+
+def recently_deleted_users(within_seconds):
+    """id пользователей, удалённых за последние within_seconds секунд.
+
+    Берутся из заданий на удаление: строка users исчезает в конце очистки.
+    """
+    with pooled_connection('recently_deleted_users') as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT user_id FROM user_deletion_jobs "
+                       "WHERE created_at > CURRENT_TIMESTAMP - make_interval(secs => %s);", (within_seconds,))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_deletion_job(user_id):
+    """Состояние фонового удаления пользователя или None, если его не запрашивали."""
+    with pooled_connection('get_deletion_job') as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT " + ", ".join(DELETION_JOB_COLUMNS) + " FROM user_deletion_jobs WHERE user_id = %s;",
+                       (user_id,))
+        row = cursor.fetchone()
+    return dict(zip(DELETION_JOB_COLUMNS, row)) if row else None
+
+
+@retry_on_disconnect
+def mark_user_deleted(user_id):
+    """Помечает пользователя удалённым и заводит задание на очистку его данных.
+
+    Быстрый запрос по первичному ключу: после него пользователь не может
+    войти, а транзакции стирает purge_user_batch. Повторный вызов не
+    создаёт второе задание, упавшее — перезапускает. Возвращает состояние
+    задания или None, если такого пользователя нет и не было.
+    """
+    with pooled_connection('mark_user_deleted') as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "UPDATE users SET deleted_at = COALESCE(deleted_at, CURRENT_TIMESTAMP) WHERE id = %s RETURNING username;",
+            (user_id,)
+        )
+        user = cursor.fetchone()
+        if user is not None:
+            cursor.execute(
+                "INSERT INTO user_deletion_jobs (user_id) VALUES (%s) "
+                "ON CONFLICT (user_id) DO UPDATE SET status = 'pending', error = NULL, updated_at = CURRENT_TIMESTAMP "
+                "WHERE user_deletion_jobs.status = 'failed';",
+                (user_id,)
+            )
+        conn.commit()
+    if user is not None:
+        logins_cache.delete(user[0])
+        invalidate_transactions([(user_id, 'income'), (user_id, 'expense')])
+    return get_deletion_job(user_id)
+
+
+def purge_user_batch(user_id, batch_size=USER_PURGE_BATCH_SIZE):
+    """Стирает до batch_size транзакций помеченного пользователя.
+
+    Выборка идёт по индексу (user_id, type, id), блокировки держатся
+    только на время одной пачки. Когда транзакций не осталось, в той же
+    транзакции удаляются предагрегаты и сам пользователь, а задание
+    закрывается. Возвращает (удалено строк, закончено ли).
+    """
+    with pooled_connection('purge_user_batch') as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM transactions WHERE (id, created_at) IN "
+            "(SELECT id, created_at FROM transactions WHERE user_id = %s LIMIT %s);",
+            (user_id, batch_size)
+        )
+        deleted = cursor.rowcount
+        done = deleted < batch_size
+        if done:
+            cursor.execute("DELETE FROM user_category_totals WHERE user_id = %s;", (user_id,))
+            cursor.execute("DELETE FROM user_daily_totals WHERE user_id = %s;", (user_id,))
+            cursor.execute("DELETE FROM transaction_idempotency_keys WHERE user_id = %s;", (user_id,))
+            try:
+                cursor.execute("DELETE FROM users WHERE id = %s AND deleted_at IS NOT NULL;", (user_id,))
+            except IntegrityError:
+                # транзакция записана уже после пометки: пачка откатывается и повторяется
+                conn.rollback()
+                return 0, False
+        cursor.execute(
+            "UPDATE user_deletion_jobs SET status = %s, deleted_rows = deleted_rows + %s, "
+            "updated_at = CURRENT_TIMESTAMP, finished_at = CASE WHEN %s THEN CURRENT_TIMESTAMP END "
+            "WHERE user_id = %s;",
+            ('done' if done else 'running', deleted, done, user_id)
+        )
+        conn.commit()
+    return deleted, done
+
+
+def fail_user_deletion(user_id, error):
+    """Отмечает задание упавшим; повторный DELETE /api/user/{id} его перезапустит."""
+    with pooled_connection('fail_user_deletion') as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "UPDATE user_deletion_jobs SET status = 'failed', error = %s, updated_at = CURRENT_TIMESTAMP "
+            "WHERE user_id = %s;",
+            (error, user_id)
+        )
+        conn.commit()
+
+
+def delete_user(user_id):
+    """Удаляет пользователя и его данные синхронно (для скриптов и бенчмарков).
+
+    То же, что фоновое удаление, но все пачки выполняются в вызывающем потоке без пауз.
+    """
+    if mark_user_deleted(user_id) is None:
+        return
+    stalls = 0
+    while True:
+        deleted, done = purge_user_batch(user_id)
+        if done:
+            return
+        stalls = 0 if deleted else stalls + 1
+        if stalls >= USER_PURGE_MAX_STALLS:
+            raise RuntimeError(f"user row is still referenced after {stalls} attempts")
@@ -0,0 +1,66 @@
+import os
+
+# Воркеры — отдельные процессы, поэтому метрики собираются в multiprocess-режиме:
+# каждый процесс пишет свои значения в файлы PROMETHEUS_MULTIPROC_DIR,
+# а HTTP-сервер в главном процессе их агрегирует.
+# Переменная должна быть выставлена до импорта prometheus_client. Файлы прошлого
+# запуска удаляются до старта процесса (см. Dockerfile): определения метрик ниже
+# уже открывают файлы этого процесса, и удалённые после импорта файлы метрики
+# продолжали бы писать мимо каталога.
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server  # noqa: E402
+from prometheus_client import multiprocess  # noqa: E402
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 8002))
+
+# --- Пул соединений с БД ---
+DB_POOL_CHECKOUTS = Counter('db_pool_checkouts_total', 'Connections checked out from the pool')
+DB_POOL_WAIT = Histogram('db_pool_wait_seconds', 'Time spent waiting for a free pooled connection',
+                         buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+DB_POOL_IN_USE = Gauge('db_pool_in_use', 'Pooled connections currently checked out', multiprocess_mode='livesum')
+DB_POOL_RECONNECTS = Counter('db_pool_reconnects_total', 'Broken pooled connections replaced with new ones')
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Time a pooled connection is held by a query', ['query'],
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+# --- Трассировка сообщений ---
+# queue wait считается по x-published-at от шлюза, поэтому зависит от синхронизации часов
+QUEUE_WAIT_SECONDS = Histogram('queue_wait_seconds', 'Time from gateway publish to worker delivery', ['queue'],
+                               buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+HANDLER_SECONDS = Histogram('handler_seconds', 'Time spent handling a message in the worker', ['queue'],
+                            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+# по x-deadline от шлюза: шлюз уже ответил 504, обработка была бы впустую
+EXPIRED_MESSAGES = Counter('rpc_expired_messages_total', 'Messages dropped by the worker after their deadline',
+                           ['queue'])
+
+# --- Автомасштабирование пулов воркеров (пишет только главный процесс) ---
+WORKER_POOL_SIZE = Gauge('worker_pool_size', 'Worker processes running in a pool', ['pool'],
+                         multiprocess_mode='livesum')
+WORKER_POOL_BACKLOG = Gauge('worker_pool_backlog', 'Ready messages in the queues of a pool', ['pool'],
+                            multiprocess_mode='livesum')
+WORKER_POOL_SCALE_EVENTS = Counter('worker_pool_scale_events_total', 'Autoscaler decisions to resize a pool',
+                                   ['pool', 'direction'])
+WORKER_CRASHES = Counter('worker_crashes_total', 'Worker processes that exited without being asked to', ['pool'])
+
+# --- Кеш чтения ---
+CACHE_HITS = Counter('cache_hits_total', 'Cache hits', ['cache'])
+CACHE_MISSES = Counter('cache_misses_total', 'Cache misses', ['cache'])
+CACHE_EVICTIONS = Counter('cache_evictions_total', 'Entries evicted from a full cache', ['cache'])
+
+# --- Хеширование паролей ---
+PASSWORD_HASH_SECONDS = Histogram('password_hash_seconds', 'Time spent hashing or verifying a password', ['op'],
+                                  buckets=(0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2.5))
+
+
+def mark_worker_dead(pid):
+    """Убирает live-gauge завершившегося воркера из агрегата."""
+    multiprocess.mark_process_dead(pid)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Поднимает /metrics, агрегирующий значения всех воркеров."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+    print(f"Prometheus metrics on :{port}")
@@ -0,0 +1,8 @@
+-- Индексы под чтение истории пользователя: фильтр по (user_id, type)
+-- и keyset-пагинация по id либо отсечка по created_at.
+-- Префикс user_id заодно покрывает удаление всех транзакций пользователя.
+CREATE INDEX IF NOT EXISTS idx_transactions_user_type_id
+    ON transactions (user_id, type, id);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created_at
+    ON transactions (user_id, type, created_at);
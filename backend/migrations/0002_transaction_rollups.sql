@@ -0,0 +1,35 @@
+-- Предагрегаты по транзакциям пользователя. Обновляются в той же
+-- транзакции, что и INSERT/DELETE в transactions, поэтому сводка
+-- читается за O(категорий), а не за O(истории).
+CREATE TABLE IF NOT EXISTS user_category_totals (
+    user_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    category TEXT NOT NULL,
+    total NUMERIC NOT NULL DEFAULT 0,
+    tx_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, type, category)
+);
+
+CREATE TABLE IF NOT EXISTS user_daily_totals (
+    user_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    day DATE NOT NULL,
+    total NUMERIC NOT NULL DEFAULT 0,
+    tx_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, type, day)
+);
+
+-- Заполняем по уже существующей истории
+INSERT INTO user_category_totals (user_id, type, category, total, tx_count)
+SELECT user_id, type, category, sum(amount), count(*)
+FROM transactions
+WHERE user_id IS NOT NULL
+GROUP BY user_id, type, category
+ON CONFLICT DO NOTHING;
+
+INSERT INTO user_daily_totals (user_id, type, day, total, tx_count)
+SELECT user_id, type, created_at::date, sum(amount), count(*)
+FROM transactions
+WHERE user_id IS NOT NULL AND created_at IS NOT NULL
+GROUP BY 1, 2, 3
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,14 @@
+-- Фоновое удаление пользователей: DELETE /api/user/{id} только ставит
+-- deleted_at, а транзакции стираются пачками воркером user_purge_queue.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+CREATE TABLE IF NOT EXISTS user_deletion_jobs (
+    -- без внешнего ключа: строка users удаляется в конце очистки, а задание остаётся
+    user_id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | running | done | failed
+    deleted_rows BIGINT NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
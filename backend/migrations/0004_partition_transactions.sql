@@ -0,0 +1,80 @@
+-- Секционирование transactions по месяцам created_at.
+-- Первичный ключ секционированной таблицы обязан включать ключ секционирования,
+-- поэтому он становится (id, created_at), а created_at — NOT NULL; id
+-- по-прежнему берётся из той же последовательности и остаётся уникальным.
+
+-- Создаёт секцию месяца month, если её ещё нет. Строки этого месяца,
+-- успевшие попасть в секцию по умолчанию, переносятся в новую секцию.
+-- Вызывается отсюда и из partitions.ensure_partitions.
+CREATE OR REPLACE FUNCTION transactions_ensure_partition(month DATE) RETURNS TEXT AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::date;
+    end_at DATE := (date_trunc('month', month) + interval '1 month')::date;
+    name TEXT := 'transactions_' || to_char(date_trunc('month', month), 'YYYY_MM');
+BEGIN
+    IF to_regclass(name) IS NOT NULL THEN
+        RETURN name;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', name);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM transactions_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+        'INSERT INTO %I SELECT * FROM moved', start_at, end_at, name);
+    EXECUTE format('ALTER TABLE transactions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   name, start_at, end_at);
+    RETURN name;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER SEQUENCE transactions_id_seq OWNED BY NONE;
+ALTER TABLE transactions RENAME TO transactions_unpartitioned;
+
+CREATE TABLE transactions (
+    id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+    user_id INTEGER REFERENCES users(id),
+    type TEXT NOT NULL, -- 'income' or 'expense'
+    category TEXT NOT NULL,
+    amount NUMERIC NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Строки вне созданных месяцев (импорт задним или будущим числом)
+CREATE TABLE transactions_default PARTITION OF transactions DEFAULT;
+
+-- Старые строки без даты получают время миграции; в дневные предагрегаты
+-- они не попадали (см. 0002), поэтому досчитываем их туда сейчас
+WITH dated AS (
+    UPDATE transactions_unpartitioned SET created_at = CURRENT_TIMESTAMP
+    WHERE created_at IS NULL AND user_id IS NOT NULL
+    RETURNING user_id, type, amount, created_at
+)
+INSERT INTO user_daily_totals (user_id, type, day, total, tx_count)
+SELECT user_id, type, created_at::date, sum(amount), count(*)
+FROM dated
+GROUP BY user_id, type, created_at::date
+ON CONFLICT (user_id, type, day) DO UPDATE
+SET total = user_daily_totals.total + EXCLUDED.total,
+    tx_count = user_daily_totals.tx_count + EXCLUDED.tx_count;
+
+UPDATE transactions_unpartitioned SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+
+-- Секции от самого раннего месяца истории до трёх месяцев вперёд
+SELECT transactions_ensure_partition(month::date)
+FROM generate_series(
+    date_trunc('month', LEAST((SELECT min(created_at) FROM transactions_unpartitioned), LOCALTIMESTAMP)),
+    date_trunc('month', LOCALTIMESTAMP) + interval '3 months',
+    interval '1 month'
+) AS month;
+
+INSERT INTO transactions (id, user_id, type, category, amount, created_at)
+SELECT id, user_id, type, category, amount, created_at FROM transactions_unpartitioned;
+
+DROP TABLE transactions_unpartitioned;
+ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id;
+
+-- Индексы из 0001, теперь на каждой секции
+CREATE INDEX IF NOT EXISTS idx_transactions_user_type_id
+    ON transactions (user_id, type, id);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created_at
+    ON transactions (user_id, type, created_at);
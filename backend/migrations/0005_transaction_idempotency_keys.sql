@@ -0,0 +1,14 @@
+-- Ключи идемпотентности записи транзакций: повтор сообщения transaction_queue
+-- (переотправка шлюзом, повторная доставка после падения воркера) с тем же
+-- ключом возвращает уже созданную транзакцию вместо новой строки.
+-- Ключ уникален в пределах пользователя; старые ключи чистит partitions.run_maintenance.
+CREATE TABLE IF NOT EXISTS transaction_idempotency_keys (
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    transaction_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_transaction_idempotency_keys_created_at
+    ON transaction_idempotency_keys (created_at);
@@ -0,0 +1,127 @@
+"""Обслуживание секций transactions (см. migrations/0004_partition_transactions.sql).
+
+Раз в PARTITION_MAINTENANCE_INTERVAL секунд создаёт секции на
+PARTITION_MONTHS_AHEAD месяцев вперёд и, если задан
+TRANSACTIONS_RETENTION_MONTHS, отсоединяет секции старше срока хранения,
+выгружает их в ARCHIVE_DIR/<секция>.csv.gz и удаляет из базы.
+Предагрегаты при архивировании не трогаются: сводка по-прежнему учитывает
+всю историю, а в списках и выгрузке архивных месяцев больше нет.
+Тем же проходом удаляются ключи идемпотентности старше
+IDEMPOTENCY_KEY_TTL_HOURS (см. database.add_transaction).
+"""
+import gzip
+import os
+import re
+import time
+from datetime import date
+
+from psycopg2 import sql
+
+import database
+
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+# 0 — хранить все месяцы в базе
+TRANSACTIONS_RETENTION_MONTHS = int(os.environ.get('TRANSACTIONS_RETENTION_MONTHS', 0))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '/var/lib/finance/archive')
+PARTITION_MAINTENANCE_INTERVAL = float(os.environ.get('PARTITION_MAINTENANCE_INTERVAL', 3600))
+# Обслуживанием занимается один бэкенд из нескольких
+PARTITION_LOCK_ID = 7215002
+
+PARTITION_NAME = re.compile(r'^transactions_(\d{4})_(\d{2})$')
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def ensure_partitions(cursor, months_ahead=PARTITION_MONTHS_AHEAD):
+    """Создаёт секции текущего месяца и months_ahead следующих."""
+    this_month = date.today().replace(day=1)
+    for offset in range(months_ahead + 1):
+        cursor.execute("SELECT transactions_ensure_partition(%s);", (add_months(this_month, offset),))
+
+
+def monthly_partitions(cursor):
+    """[(месяц, имя таблицы, подключена ли к transactions)] по возрастанию месяца.
+
+    Отсоединённые таблицы тоже попадают в список: если прошлый запуск
+    упал между DETACH и DROP, архивирование доделывается.
+    """
+    cursor.execute(
+        "SELECT relname, relispartition FROM pg_class "
+        "WHERE relkind = 'r' AND relname ~ '^transactions_[0-9]{4}_[0-9]{2}$';"
+    )
+    partitions = []
+    for name, attached in cursor.fetchall():
+        year, month = PARTITION_NAME.match(name).groups()
+        partitions.append((date(int(year), int(month), 1), name, attached))
+    return sorted(partitions)
+
+
+def archive_partition(conn, name, attached=True):
+    """Отсоединяет секцию, пишет её в ARCHIVE_DIR/<name>.csv.gz и удаляет таблицу."""
+    table = sql.Identifier(name)
+    if attached:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("ALTER TABLE transactions DETACH PARTITION {};").format(table))
+        conn.commit()
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, name + '.csv.gz')
+    # файл появляется под своим именем только целиком записанным
+    with gzip.open(path + '.tmp', 'wb') as f, conn.cursor() as cursor:
+        cursor.copy_expert(sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(table), f)
+    os.replace(path + '.tmp', path)
+
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("DROP TABLE {};").format(table))
+    conn.commit()
+    print(f"Partition {name} archived to {path}")
+
+
+def archive_old_partitions(conn, retention_months=TRANSACTIONS_RETENTION_MONTHS):
+    """Архивирует месяцы, целиком вышедшие за срок хранения."""
+    cutoff = add_months(date.today().replace(day=1), -retention_months)
+    with conn.cursor() as cursor:
+        partitions = monthly_partitions(cursor)
+    conn.commit()
+    for month, name, attached in partitions:
+        if month < cutoff:
+            archive_partition(conn, name, attached)
+
+
+def run_maintenance():
+    """Один проход обслуживания; пропускается, если его уже выполняет другой бэкенд."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s);", (PARTITION_LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                return
+            try:
+                ensure_partitions(cursor)
+                conn.commit()
+                if TRANSACTIONS_RETENTION_MONTHS > 0:
+                    archive_old_partitions(conn)
+                # заодно — ключи идемпотентности, которые клиент уже не станет повторять
+                purged = database.purge_idempotency_keys()
+                if purged:
+                    print(f"{purged} expired idempotency keys purged")
+            finally:
+                conn.rollback()
+                cursor.execute("SELECT pg_advisory_unlock(%s);", (PARTITION_LOCK_ID,))
+                conn.commit()
+    finally:
+        conn.close()
+
+
+def maintenance_loop(interval=PARTITION_MAINTENANCE_INTERVAL):
+    """Цикл для отдельного процесса рядом с воркерами."""
+    while True:
+        try:
+            run_maintenance()
+        except Exception as e:
+            print(f"Partition maintenance failed: {e}")
+        time.sleep(interval)
@@ -0,0 +1,122 @@
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import PASSWORD_HASH_SECONDS
+
+
+# Параметры scrypt; при их изменении старые хеши пересчитываются при следующем входе
+SCRYPT_N = int(os.environ.get('SCRYPT_N', 2 ** 14))
+SCRYPT_R = int(os.environ.get('SCRYPT_R', 8))
+SCRYPT_P = int(os.environ.get('SCRYPT_P', 1))
+# Процессов для хеширования в каждом воркере: scrypt держит GIL и CPU,
+# поэтому считается вне процесса, который обслуживает AMQP-соединение
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+
+HASH_PREFIX = 'scrypt'
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode()
+
+
+def _derive(password, salt, n, r, p):
+    # scrypt требует 128 * r * n байт памяти, берём с запасом
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * n, dklen=KEY_BYTES)
+
+
+def _format(salt, key):
+    return '$'.join([HASH_PREFIX, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P), _b64(salt), _b64(key)])
+
+
+def _hash(password):
+    salt = os.urandom(SALT_BYTES)
+    return _format(salt, _derive(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P))
+
+
+# Хеш, с которым сверяется пароль несуществующего пользователя: проверка
+# стоит столько же, сколько настоящая, и по времени ответа не видно, есть
+# ли такой логин. Ключ случайный, так что ни один пароль к нему не подходит.
+DUMMY_HASH = _format(os.urandom(SALT_BYTES), os.urandom(KEY_BYTES))
+
+
+def hash_password(password):
+    """Возвращает строку вида scrypt$n$r$p$salt$hash с текущими параметрами."""
+    started = time.perf_counter()
+    password_hash = _hash(password)
+    PASSWORD_HASH_SECONDS.labels('hash').observe(time.perf_counter() - started)
+    return password_hash
+
+
+def verify_password(password, stored):
+    """Проверяет пароль и возвращает (совпал ли, новый хеш или None).
+
+    Новый хеш возвращается, если пароль верный, а сохранённое значение —
+    открытый текст старого формата или хеш с устаревшими параметрами.
+    В метрику попадает одно наблюдение verify, вместе с пересчётом хеша.
+    """
+    started = time.perf_counter()
+    new_hash = None
+    if not stored.startswith(HASH_PREFIX + '$'):
+        ok = hmac.compare_digest(stored.encode(), password.encode())
+        if ok:
+            new_hash = _hash(password)
+    else:
+        _, n, r, p, salt, key = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        ok = hmac.compare_digest(_derive(password, base64.b64decode(salt), n, r, p), base64.b64decode(key))
+        if ok and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P):
+            new_hash = _hash(password)
+    PASSWORD_HASH_SECONDS.labels('verify').observe(time.perf_counter() - started)
+    return ok, new_hash
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Пул процессов для хеширования, свой в каждом воркере.
+
+    Процессы пула запускаются через spawn: fork копировал бы воркер вместе
+    с потоками pika и пулом соединений с БД, а хешированию ничего из этого не нужно.
+    """
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def shutdown_executor():
+    """Останавливает пул хеширования этого процесса.
+
+    Процессы пула не daemon: без остановки выход воркера ждал бы их вечно.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=True)
+        _executor = None
+
+
+def submit_hash(password):
+    """Future со строкой хеша."""
+    return get_executor().submit(hash_password, password)
+
+
+def submit_verify(password, stored):
+    """Future с результатом verify_password."""
+    return get_executor().submit(verify_password, password, stored)
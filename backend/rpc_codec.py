@@ -0,0 +1,87 @@
+"""Кодеки тел RPC-сообщений между шлюзом и воркерами.
+
+Кодек выбирается по AMQP content_type: application/json (через orjson,
+если он установлен, иначе stdlib json) или application/msgpack (если
+установлен msgpack). Decimal кодируется числом, datetime и date — строкой
+ISO 8601. Файл одинаковый в backend/ и api_gateway/.
+"""
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Кодек запросов шлюза к воркерам: json или msgpack (без пакета msgpack — json)
+RPC_CODEC = os.environ.get('RPC_CODEC', 'json')
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not serializable")
+
+
+if orjson is not None:
+    # datetime и date orjson пишет сам, в hook попадает только Decimal
+    def dumps_json(obj):
+        return orjson.dumps(obj, default=_default)
+
+    loads_json = orjson.loads
+else:
+    def dumps_json(obj):
+        return json.dumps(obj, default=_default).encode()
+
+    loads_json = json.loads
+
+
+CODECS = {JSON: (dumps_json, loads_json)}
+
+if msgpack is not None:
+    def dumps_msgpack(obj):
+        return msgpack.packb(obj, default=_default)
+
+    def loads_msgpack(body):
+        return msgpack.unpackb(body, raw=False)
+
+    CODECS[MSGPACK] = (dumps_msgpack, loads_msgpack)
+
+
+def content_type_for(name):
+    """content_type по имени кодека из RPC_CODEC; недоступный кодек заменяется JSON."""
+    content_type = {'json': JSON, 'msgpack': MSGPACK}.get(name, JSON)
+    return content_type if content_type in CODECS else JSON
+
+
+def negotiate(content_type, accept=None):
+    """Кодек ответа: запрошенный в x-accept, иначе тот же, что у запроса, иначе JSON."""
+    for candidate in (accept, content_type):
+        if candidate in CODECS:
+            return candidate
+    return JSON
+
+
+def encode(obj, content_type=JSON):
+    return CODECS[content_type][0](obj)
+
+
+def decode(body, content_type=None):
+    """Разбирает тело по content_type; сообщения без него считаются JSON."""
+    codec = CODECS.get(content_type or JSON)
+    if codec is None:
+        raise ValueError(f"Unsupported content_type: {content_type}")
+    return codec[1](body)
@@ -1,14 +1,79 @@
 import pika
-import json
+import autoscaler
+import cache
+import csv
 import database
+import functools
+import io
+import metrics
+import partitions
+import passwords
+import rpc_codec
 import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 from datetime import datetime
+from metrics import EXPIRED_MESSAGES, HANDLER_SECONDS, QUEUE_WAIT_SECONDS
 
 
 # Настройки
-RABBITMQ_HOST = 'rabbitmq'
-NUM_WORKERS = 4  # Можешь увеличить до 8+ если CPU позволяет
+RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
+NUM_WORKERS = int(os.environ.get('NUM_WORKERS', 4))  # Можешь увеличить до 8+ если CPU позволяет
+# До скольких процессов супервизор может растянуть пул под нагрузкой (см. autoscaler)
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', NUM_WORKERS))
+PREFETCH_COUNT = 10
+
+# Пакетная запись транзакций: до N сообщений или T мс на один INSERT.
+# 1 — пакетирование выключено, каждое сообщение пишется отдельно.
+TRANSACTION_BATCH_SIZE = int(os.environ.get('TRANSACTION_BATCH_SIZE', 1))
+TRANSACTION_BATCH_MS = int(os.environ.get('TRANSACTION_BATCH_MS', 20))
+
+# Сколько сообщений одной очереди обрабатывать одновременно в одном воркере.
+# 1 — прямо на потоке соединения, больше — в пуле потоков этой очереди.
+# QUEUE_CONCURRENCY переопределяет значение для отдельных очередей:
+# "login_queue=4,transaction_get_queue=8".
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 1))
+
+
+def parse_queue_map(raw, cast=int):
+    """Разбирает строку вида "queue=value,queue2=value2" в словарь."""
+    result = {}
+    for item in filter(None, (part.strip() for part in raw.split(','))):
+        queue, _, value = item.partition('=')
+        result[queue.strip()] = cast(value)
+    return result
+
+
+QUEUE_CONCURRENCY = parse_queue_map(os.environ.get('QUEUE_CONCURRENCY', ''))
+# prefetch_count отдельно для каждой очереди, по умолчанию PREFETCH_COUNT
+QUEUE_PREFETCH = parse_queue_map(os.environ.get('QUEUE_PREFETCH', ''))
+
+
+def parse_worker_pools(raw):
+    """Разбирает WORKER_POOLS вида "login_queue=2;transaction_queue+summary_queue=1-4;*=2".
+
+    Каждая группа — очереди через '+' и число процессов, которые
+    потребляют только их: N или диапазон min-max, в котором супервизор
+    меняет размер пула по нагрузке. '*' — все очереди, не попавшие
+    в другие группы. Возвращает [(имя группы, очереди, min, max)].
+    """
+    pools = []
+    for item in filter(None, (part.strip() for part in raw.split(';'))):
+        queues, _, processes = item.partition('=')
+        low, _, high = processes.partition('-')
+        min_size, max_size = int(low), int(high or low)
+        if not 1 <= min_size <= max_size:
+            raise ValueError(f"Bad worker pool size: {item}")
+        pools.append((queues.strip(), [queue.strip() for queue in queues.split('+')], min_size, max_size))
+    return pools
+
+
+# Без WORKER_POOLS все процессы (от NUM_WORKERS до MAX_WORKERS) слушают все очереди
+WORKER_POOLS = parse_worker_pools(os.environ.get('WORKER_POOLS', '') or f"*={NUM_WORKERS}-{MAX_WORKERS}")
 
 REGISTER_QUEUE = 'register_queue'
 LOGIN_QUEUE = 'login_queue'
@@ -16,150 +81,776 @@ TRANSACTION_QUEUE = 'transaction_queue'
 TRANSACTION_GET_QUEUE = 'transaction_get_queue'
 DELETE_TRANSACTION_QUEUE = 'delete_transaction_queue'
 DELETE_USER_QUEUE = 'delete_user_queue'
+SUMMARY_QUEUE = 'summary_queue'
+TRANSACTION_BULK_QUEUE = 'transaction_bulk_queue'
+TRANSACTION_EXPORT_QUEUE = 'transaction_export_queue'
+USER_PURGE_QUEUE = 'user_purge_queue'
+USER_DELETION_STATUS_QUEUE = 'user_deletion_status_queue'
+REVOKED_USERS_QUEUE = 'revoked_users_queue'
+
+# Сколько ошибок по отдельным строкам возвращать на один кусок массового импорта
+BULK_MAX_ERRORS = int(os.environ.get('BULK_MAX_ERRORS', 100))
 
+# Очереди, обработчики которых ждут пул хеширования паролей
+PASSWORD_QUEUES = (REGISTER_QUEUE, LOGIN_QUEUE)
+# Очереди, отвечающие потоком сообщений (см. make_stream_callback)
+STREAM_QUEUES = (TRANSACTION_EXPORT_QUEUE,)
+# Очереди с долгими обработчиками: всегда выполняются в executor, а не на потоке соединения
+LONG_RUNNING_QUEUES = STREAM_QUEUES + (USER_PURGE_QUEUE,)
+# Окно потокового ответа: сколько кусков может быть отправлено, но ещё не
+# записано шлюзом клиенту (см. StreamCredits)
+STREAM_WINDOW = int(os.environ.get('STREAM_WINDOW', 4))
+# Сколько ждать кредита от шлюза, прежде чем считать, что выгрузку никто не читает
+STREAM_CREDIT_TIMEOUT = float(os.environ.get('STREAM_CREDIT_TIMEOUT', 60))
 
-def custom_serializer(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_FIELDS = ('id', 'type', 'category', 'amount', 'created_at')
 
 
 def respond(ch, properties, response):
+    """Отвечает в кодеке, который запросил шлюз (x-accept), по умолчанию — в кодеке запроса.
+
+    x-status дублирует статус ответа, чтобы шлюз мог отдать тело клиенту, не разбирая его.
+    Фоновые задания (без reply_to) ответа не получают.
+    """
+    if not properties.reply_to:
+        return
+    request_headers = properties.headers or {}
+    content_type = rpc_codec.negotiate(properties.content_type, request_headers.get('x-accept'))
+    headers = {'x-status': response.get('status')}
+    if request_headers.get('x-request-id'):
+        headers['x-request-id'] = request_headers['x-request-id']
     ch.basic_publish(
         exchange='',
         routing_key=properties.reply_to,
-        body=json.dumps(response, default=custom_serializer),
-        properties=pika.BasicProperties(correlation_id=properties.correlation_id)
+        body=rpc_codec.encode(response, content_type),
+        properties=pika.BasicProperties(
+            correlation_id=properties.correlation_id,
+            content_type=content_type,
+            headers=headers
+        )
     )
 
 
-# --- Callback-функции ---
-def register_callback(ch, method, properties, body):
-    message = json.loads(body)
-    username = message['username']
-    password = message['password']
-    response = {}
-    user_id = None
-    for i in range(5):
+_publisher = threading.local()
+
+
+def thread_channel():
+    """Канал на собственном соединении текущего потока.
+
+    Соединение, на котором воркер потребляет сообщения, можно трогать
+    только с его потока, поэтому потоки executors заводят свои.
+    """
+    channel = getattr(_publisher, 'channel', None)
+    if channel is None or channel.is_closed:
+        # без heartbeat: соединение простаивает между заданиями и никем не обслуживается
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, heartbeat=0))
+        channel = _publisher.channel = connection.channel()
+    return channel
+
+
+def enqueue(queue, message):
+    """Ставит фоновое задание в очередь воркеров."""
+    body = rpc_codec.encode(message)
+    properties = pika.BasicProperties(delivery_mode=2, content_type=rpc_codec.JSON)
+    for attempt in range(2):
+        channel = thread_channel()
         try:
-            new_user_id = database.create_user(username, password)
-            if user_id is None:
-                user_id = new_user_id
-            print(f"[{i+1}/5] User {username} registered with ID {new_user_id}")
-        except Exception as e:
-            print(f"[{i+1}/5] Duplicate or error registering {username}: {e}")
-    response = {'status': 'success', 'user_id': user_id} if user_id else {
-        'status': 'failure', 'error': 'All 5 attempts failed'}
+            channel.basic_publish(exchange='', routing_key=queue, body=body, properties=properties)
+            return
+        except pika.exceptions.AMQPError:
+            _publisher.channel = None
+            if attempt:
+                raise
+
+
+def observe_queue_wait(queue, properties):
+    """Сколько сообщение пролежало в очереди: от публикации шлюзом до доставки воркеру."""
+    published_at = (properties.headers or {}).get('x-published-at')
+    if published_at is not None:
+        QUEUE_WAIT_SECONDS.labels(queue).observe(max(0.0, time.time() - float(published_at)))
+
+
+def expired(queue, properties):
+    """Истёк ли x-deadline запроса; просроченное сообщение подтверждается без ответа.
+
+    Брокер выбрасывает по expiration только сообщения из головы очереди,
+    а это — доставленные, но дождавшиеся своей очереди в пуле потоков.
+    Сравнение идёт с часами шлюза, поэтому они должны быть синхронизированы.
+    """
+    deadline = (properties.headers or {}).get('x-deadline')
+    if deadline is None or time.time() < float(deadline):
+        return False
+    EXPIRED_MESSAGES.labels(queue).inc()
+    return True
+
+
+def reply_and_ack(ch, method, properties, response):
     respond(ch, properties, response)
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
-def delete_user_callback(ch, method, properties, body):
-    message = json.loads(body)
-    user_id = message['user_id']
+# --- Обработчики: сообщение -> ответ ---
+def register_handler(message):
+    username = message['username']
+    password = message['password']
     try:
-        database.delete_user(user_id)
-        response = {'status': 'success'}
-        print(f"User {user_id} deleted.")
+        # хеш считается в пуле процессов, поток лишь ждёт результат
+        password_hash = passwords.submit_hash(password).result()
+        user_id, created, stored_hash = database.create_user(username, password_hash)
+        if created:
+            response = {'status': 'success', 'user_id': user_id}
+            print(f"User {username} registered with ID {user_id}")
+        # Логин занят: повтор той же регистрации получает уже созданный id
+        elif passwords.submit_verify(password, stored_hash).result()[0]:
+            response = {'status': 'success', 'user_id': user_id}
+            print(f"User {username} already registered with ID {user_id}")
+        else:
+            response = {'status': 'failure', 'error': "Логин уже занят. Выберите другой."}
+            print(f"Username {username} is taken")
+    except Exception as e:
+        response = {'status': 'failure', 'error': str(e)}
+        print(f"Failed to register {username}: {e}")
+    return response
+
+
+def delete_user_handler(message):
+    """Помечает пользователя удалённым; данные стирает purge_user_handler в фоне."""
+    user_id = int(message['user_id'])
+    try:
+        job = database.mark_user_deleted(user_id)
+        if job is None:
+            response = {'status': 'failure', 'error': 'Пользователь не найден'}
+        else:
+            if job['status'] == 'pending':
+                enqueue(USER_PURGE_QUEUE, {'user_id': user_id})
+            response = {'status': 'success', 'deletion': job}
+            print(f"User {user_id} marked as deleted, purge {job['status']}.")
     except Exception as e:
         response = {'status': 'failure', 'error': str(e)}
         print(f"Failed to delete user {user_id}: {e}")
-    respond(ch, properties, response)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    return response
+
+
+def purge_user_handler(message):
+    """Стирает транзакции помеченного пользователя пачками по USER_PURGE_BATCH_SIZE.
+
+    Между пачками пауза USER_PURGE_THROTTLE_MS, чтобы очистка большой истории
+    не забирала БД у онлайн-запросов. Если воркер упадёт посреди очистки,
+    сообщение вернётся в очередь и очистка продолжится с того же места.
+    Если пачка USER_PURGE_MAX_STALLS раз подряд откатилась, ничего не удалив,
+    задание отмечается упавшим, а не повторяется бесконечно.
+    """
+    user_id = int(message['user_id'])
+    total = 0
+    stalls = 0
+    try:
+        while True:
+            deleted, done = database.purge_user_batch(user_id, database.USER_PURGE_BATCH_SIZE)
+            total += deleted
+            if done:
+                break
+            stalls = 0 if deleted else stalls + 1
+            if stalls >= database.USER_PURGE_MAX_STALLS:
+                raise RuntimeError(f"user row is still referenced after {stalls} attempts")
+            time.sleep(database.USER_PURGE_THROTTLE_MS / 1000)
+        response = {'status': 'success', 'deleted_rows': total}
+        print(f"User {user_id} purged, {total} transactions deleted.")
+    except Exception as e:
+        database.fail_user_deletion(user_id, str(e))
+        response = {'status': 'failure', 'error': str(e)}
+        print(f"Failed to purge user {user_id}: {e}")
+    return response
 
 
-def login_callback(ch, method, properties, body):
-    message = json.loads(body)
+def deletion_status_handler(message):
+    user_id = int(message['user_id'])
+    try:
+        job = database.get_deletion_job(user_id)
+        if job is None:
+            response = {'status': 'failure', 'error': 'Удаление не запрашивалось'}
+        else:
+            response = {'status': 'success', 'deletion': job}
+    except Exception as e:
+        response = {'status': 'failure', 'error': str(e)}
+        print(f"Failed to fetch deletion status for user {user_id}: {e}")
+    return response
+
+
+def revoked_users_handler(message):
+    """Удалённые пользователи, чьи токены ещё могут быть живы (within — срок жизни токена)."""
+    return {'status': 'success', 'user_ids': database.recently_deleted_users(float(message['within']))}
+
+
+def login_handler(message):
     username = message['username']
     password = message['password']
-    user_id = database.authenticate_user(username, password)
-    response = {'status': 'success', 'user_id': user_id} if user_id else {
+    ok = False
+    try:
+        credentials = database.get_credentials(username)
+        if credentials is None:
+            # неизвестный логин проверяется так же долго, как известный
+            passwords.submit_verify(password, passwords.DUMMY_HASH).result()
+        else:
+            user_id, stored_hash = credentials
+            ok, new_hash = passwords.submit_verify(password, stored_hash).result()
+            if ok and new_hash:
+                # старый формат или устаревшие параметры — пересохраняем прозрачно
+                database.update_password_hash(user_id, username, new_hash)
+    except Exception as e:
+        print(f"Password check failed for {username}: {e}")
+        ok = False
+    response = {'status': 'success', 'user_id': user_id} if ok else {
         'status': 'failure', 'user_id': None}
     print(f"User {username} login status: {response['status']}")
-    respond(ch, properties, response)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    return response
 
 
-def transaction_callback(ch, method, properties, body):
-    message = json.loads(body)
+def transaction_handler(message):
     try:
         transaction_id = database.add_transaction(
             message['user_id'],
             message['type'],
             message['category'],
-            message['amount']
+            message['amount'],
+            message.get('idempotency_key')
         )
         response = {'status': 'success', 'transaction_id': transaction_id}
         print(f"Transaction {transaction_id} added.")
     except Exception as e:
         response = {'status': 'failure', 'error': str(e)}
         print(f"Transaction failed: {e}")
-    respond(ch, properties, response)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    return response
 
 
-def transaction_get_callback(ch, method, properties, body):
-    message = json.loads(body)
+def transaction_get_handler(message):
     try:
+        limit = database.page_size(message.get('limit'))
         transactions = database.get_transactions(
-            message['user_id'], message['type'])
-        response = {'status': 'success', 'transactions': transactions}
+            message['user_id'], message['type'],
+            limit=limit,
+            after_id=message.get('after_id'),
+            before=message.get('before'),
+            since=message.get('since')
+        )
+        # неполная страница — значит, дальше ничего нет
+        next_after_id = transactions[-1]['id'] if len(transactions) >= limit else None
+        response = {'status': 'success', 'transactions': transactions, 'next_after_id': next_after_id}
         print(f"Fetched transactions for user {message['user_id']}")
     except Exception as e:
         response = {'status': 'failure', 'error': str(e)}
         print(f"Failed to fetch transactions: {e}")
-    respond(ch, properties, response)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    return response
+
+
+def summary_handler(message):
+    try:
+        summary = database.get_summary(
+            message['user_id'],
+            period=message.get('period', 'month'),
+            date_from=message.get('from'),
+            date_to=message.get('to')
+        )
+        response = {'status': 'success', **summary}
+        print(f"Fetched summary for user {message['user_id']}")
+    except Exception as e:
+        response = {'status': 'failure', 'error': str(e)}
+        print(f"Failed to fetch summary: {e}")
+    return response
 
 
-def transaction_delete_callback(ch, method, properties, body):
-    message = json.loads(body)
+def transaction_delete_handler(message):
     try:
-        database.delete_transaction(message['transaction_id'])
+        database.delete_transaction(message['transaction_id'], message.get('created_at') or None,
+                                    message.get('user_id'))
         response = {'status': 'success'}
         print(f"Transaction {message['transaction_id']} deleted.")
     except Exception as e:
         response = {'status': 'failure', 'error': str(e)}
         print(f"Failed to delete transaction: {e}")
-    respond(ch, properties, response)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    return response
+
+
+def parse_bulk_row(fields):
+    """Проверяет одну строку импорта и возвращает (type, category, amount, created_at)."""
+    transaction_type = fields.get('type')
+    if transaction_type not in ('income', 'expense'):
+        raise ValueError("type должен быть income или expense")
+    category = (fields.get('category') or '').strip()
+    if not category:
+        raise ValueError("пустая category")
+    try:
+        amount = Decimal(str(fields.get('amount')))
+    except ArithmeticError:
+        raise ValueError(f"некорректная amount: {fields.get('amount')!r}")
+    if not amount.is_finite():
+        raise ValueError(f"некорректная amount: {fields.get('amount')!r}")
+    created_at = fields.get('created_at') or None
+    if created_at is not None:
+        created_at = datetime.fromisoformat(created_at)
+    return transaction_type, category, amount, created_at
+
+
+def bulk_import_handler(message):
+    """Кусок массового импорта: проверяет строки и пишет годные одним COPY.
+
+    Шлюз присылает исходные строки CSV (с заголовком header) или NDJSON
+    и номер первой из них, чтобы ошибки ссылались на строку загруженного файла.
+    """
+    if message.get('format') == 'ndjson':
+        items = message['lines']
+        parse = rpc_codec.loads_json
+    else:
+        items = csv.reader(message['lines'])
+        parse = lambda fields: dict(zip(message['header'], fields))  # noqa: E731
+
+    rows, errors, rejected = [], [], 0
+    for line_no, item in enumerate(items, start=message.get('first_line', 1)):
+        if not item or (isinstance(item, str) and not item.strip()):
+            continue  # пустые строки не считаются ошибкой
+        try:
+            rows.append(parse_bulk_row(parse(item)))
+        except (ValueError, TypeError, AttributeError) as e:
+            rejected += 1
+            if len(errors) < BULK_MAX_ERRORS:
+                errors.append({'line': line_no, 'error': str(e)})
+
+    try:
+        inserted = database.import_transactions(message['user_id'], rows) if rows else 0
+        response = {'status': 'success', 'inserted': inserted, 'rejected': rejected, 'errors': errors}
+        print(f"Bulk chunk for user {message['user_id']}: {inserted} inserted, {rejected} rejected")
+    except Exception as e:
+        response = {'status': 'failure', 'error': str(e), 'inserted': 0, 'rejected': rejected + len(rows),
+                    'errors': errors}
+        print(f"Bulk chunk failed: {e}")
+    return response
+
+
+def encode_export_chunk(rows, fmt, header=False):
+    """Кодирует пачку строк выгрузки в bytes CSV или NDJSON."""
+    if fmt == 'ndjson':
+        return b''.join(rpc_codec.dumps_json(dict(zip(EXPORT_FIELDS, row))) + b'\n' for row in rows)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    writer.writerows(rows)
+    return out.getvalue().encode()
+
+
+def export_handler(message):
+    """Выгрузка транзакций пользователя: генератор кусков bytes.
+
+    Формат совпадает с массовым импортом, так что выгруженный CSV можно
+    загрузить обратно (лишняя колонка id при импорте игнорируется).
+    """
+    fmt = message.get('format') or 'csv'
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format должен быть одним из: {', '.join(EXPORT_FORMATS)}")
+    user_id = int(message['user_id'])
+    transaction_type = message.get('type') or None
+    if transaction_type not in (None, 'income', 'expense'):
+        raise ValueError("type должен быть income или expense")
+
+    header = fmt == 'csv'
+    for rows in database.export_transactions(user_id, transaction_type):
+        yield encode_export_chunk(rows, fmt, header)
+        header = False
+    if header:
+        yield encode_export_chunk([], fmt, header)
+
+
+HANDLERS = {
+    REGISTER_QUEUE: register_handler,
+    LOGIN_QUEUE: login_handler,
+    TRANSACTION_QUEUE: transaction_handler,
+    TRANSACTION_GET_QUEUE: transaction_get_handler,
+    DELETE_TRANSACTION_QUEUE: transaction_delete_handler,
+    DELETE_USER_QUEUE: delete_user_handler,
+    SUMMARY_QUEUE: summary_handler,
+    TRANSACTION_BULK_QUEUE: bulk_import_handler,
+    TRANSACTION_EXPORT_QUEUE: export_handler,
+    USER_PURGE_QUEUE: purge_user_handler,
+    USER_DELETION_STATUS_QUEUE: deletion_status_handler,
+    REVOKED_USERS_QUEUE: revoked_users_handler,
+}
+
+
+def handle(handler, body, content_type=None):
+    """Разбирает тело и вызывает обработчик.
+
+    Битое сообщение и любое исключение обработчика (ошибка БД, пустой пул
+    соединений) превращаются в ответ с ошибкой: без ответа шлюз ждал бы
+    до своего таймаута.
+    """
+    try:
+        return handler(rpc_codec.decode(body, content_type))
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Invalid message: {e}")
+        return {'status': 'failure', 'error': f"Invalid message: {e}"}
+    except Exception as e:
+        print(f"Handler {handler.__name__} failed: {e}")
+        return {'status': 'failure', 'error': str(e)}
+
+
+def queue_concurrency(queue):
+    """Сколько сообщений очереди воркер обрабатывает одновременно."""
+    if queue in QUEUE_CONCURRENCY:
+        return QUEUE_CONCURRENCY[queue]
+    if queue in PASSWORD_QUEUES:
+        # ждать пул хеширования прямо на потоке соединения — значит стоять всем очередям
+        return max(WORKER_CONCURRENCY, passwords.PASSWORD_HASH_WORKERS)
+    return WORKER_CONCURRENCY
+
+
+def make_callback(queue, handler, executor=None):
+    """on_message_callback для pika.
+
+    Без executor обработчик выполняется прямо на потоке соединения.
+    С executor — в пуле потоков (каждый поток берёт своё соединение из
+    пула БД), а ответ и ack возвращаются на поток соединения через
+    add_callback_threadsafe: pika не потокобезопасна.
+    """
+    def run(properties, body):
+        with HANDLER_SECONDS.labels(queue).time():
+            return handle(handler, body, properties.content_type)
+
+    def inline(ch, method, properties, body):
+        observe_queue_wait(queue, properties)
+        if expired(queue, properties):
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        reply_and_ack(ch, method, properties, run(properties, body))
+
+    def dispatch(ch, method, properties, body):
+        observe_queue_wait(queue, properties)
+        if expired(queue, properties):
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        def work():
+            # исключение здесь проглотил бы Future: сообщение осталось бы без ответа
+            # и без ack и занимало бы слот prefetch до закрытия соединения
+            response = None
+            try:
+                if not expired(queue, properties):
+                    response = run(properties, body)
+            except Exception as e:
+                print(f"Failed to handle a message from {queue}: {e}")
+                response = {'status': 'failure', 'error': str(e)}
+            finally:
+                if response is None:
+                    callback = functools.partial(ch.basic_ack, delivery_tag=method.delivery_tag)
+                else:
+                    callback = functools.partial(reply_and_ack, ch, method, properties, response)
+                ch.connection.add_callback_threadsafe(callback)
+        executor.submit(work)
+
+    return inline if executor is None else dispatch
+
+
+class StreamCredits:
+    """Кредиты потокового ответа от шлюза.
+
+    Воркер начинает с STREAM_WINDOW кредитами и тратит по одному на кусок;
+    шлюз возвращает кредит (пустое сообщение в очередь из заголовка
+    x-credit-to) только после того, как записал кусок клиенту. Поэтому
+    в RabbitMQ и в памяти шлюза одновременно не больше STREAM_WINDOW кусков,
+    а медленный клиент тормозит чтение из базы, а не копит выгрузку в брокере.
+    Работает на соединении потока executor (см. thread_channel).
+    """
+
+    def __init__(self, window=STREAM_WINDOW):
+        self.available = window
+        self.channel = thread_channel()
+        self.queue = self.channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+        self.consumer_tag = self.channel.basic_consume(queue=self.queue, on_message_callback=self.on_credit,
+                                                       auto_ack=True)
+
+    def on_credit(self, ch, method, properties, body):
+        self.available += 1
+
+    def take(self, timeout=STREAM_CREDIT_TIMEOUT):
+        deadline = time.time() + timeout
+        while self.available == 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError(f"No credit from the gateway in {timeout}s, stream abandoned")
+            self.channel.connection.process_data_events(time_limit=remaining)
+        self.available -= 1
+
+    def close(self):
+        """Удаляет очередь кредитов; опоздавшие кредиты брокер просто отбросит."""
+        try:
+            self.channel.basic_cancel(self.consumer_tag)
+            self.channel.queue_delete(self.queue)
+        except pika.exceptions.AMQPError as e:
+            _publisher.channel = None
+            print(f"Failed to delete credit queue {self.queue}: {e}")
+
+
+def stream_reply(ch, properties, kind, body, credit_to=None):
+    """Одно сообщение потокового ответа: kind — chunk, end или error."""
+    headers = {'x-stream': kind}
+    if credit_to:
+        headers['x-credit-to'] = credit_to
+    request_id = (properties.headers or {}).get('x-request-id')
+    if request_id:
+        headers['x-request-id'] = request_id
+    ch.basic_publish(
+        exchange='',
+        routing_key=properties.reply_to,
+        body=body,
+        properties=pika.BasicProperties(correlation_id=properties.correlation_id, headers=headers)
+    )
+
+
+def make_stream_callback(queue, handler, executor):
+    """on_message_callback для очередей из STREAM_QUEUES.
+
+    Обработчик — генератор bytes. Каждый кусок уходит отдельным
+    сообщением с заголовком x-stream: chunk и тем же correlation_id,
+    за ними — x-stream: end или error с JSON-ответом. Генератор работает
+    в executor, публикация — на потоке соединения. Перед каждым куском
+    генератор ждёт кредит от шлюза (см. StreamCredits), поэтому ни память
+    воркера, ни брокер, ни шлюз не зависят от объёма выгрузки.
+    ack — после последнего сообщения.
+    """
+    def dispatch(ch, method, properties, body):
+        observe_queue_wait(queue, properties)
+        if expired(queue, properties):
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        def publish(kind, payload, credit_to=None):
+            ch.connection.add_callback_threadsafe(
+                functools.partial(stream_reply, ch, properties, kind, payload, credit_to))
+
+        def work():
+            credits = None
+            with HANDLER_SECONDS.labels(queue).time():
+                chunks = 0
+                try:
+                    credits = StreamCredits()
+                    for chunk in handler(rpc_codec.decode(body, properties.content_type)):
+                        credits.take()
+                        publish('chunk', chunk, credits.queue)
+                        chunks += 1
+                    publish('end', rpc_codec.dumps_json({'status': 'success', 'chunks': chunks}))
+                except Exception as e:
+                    print(f"Stream from {queue} failed after {chunks} chunks: {e}")
+                    publish('error', rpc_codec.dumps_json({'status': 'failure', 'error': str(e)}))
+                finally:
+                    if credits is not None:
+                        credits.close()
+            ch.connection.add_callback_threadsafe(functools.partial(ch.basic_ack, delivery_tag=method.delivery_tag))
+        executor.submit(work)
+
+    return dispatch
+
+
+class TransactionBatcher:
+    """Копит сообщения transaction_queue и пишет их одним INSERT.
+
+    Пачка сбрасывается, когда набралось max_size сообщений или прошло
+    max_wait_ms с первого из них. Каждый отправитель получает свой
+    transaction_id по своему reply_to/correlation_id. Если пачка не
+    записалась целиком, сообщения пишутся по одному, чтобы одна плохая
+    строка не роняла остальные. Работает на отдельном канале, поэтому
+    вся пачка подтверждается одним basic_ack(multiple=True).
+
+    С executor запись идёт в фоновом потоке. Он должен быть
+    однопоточным: пачки подтверждаются по порядку, иначе ack(multiple)
+    поздней пачки задел бы ещё не записанную раннюю.
+    """
+
+    def __init__(self, connection, channel, max_size, max_wait_ms, executor=None):
+        self.connection = connection
+        self.channel = channel
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.pending = []
+        self.timer = None
+
+    def on_message(self, ch, method, properties, body):
+        observe_queue_wait(TRANSACTION_QUEUE, properties)
+        if expired(TRANSACTION_QUEUE, properties):
+            # ack(multiple) следующей пачки уже подтверждённый тег просто пропустит
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        self.pending.append((method, properties, body))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.connection.call_later(self.max_wait, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.connection.remove_timeout(self.timer)
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        if self.executor is None:
+            self.reply(batch, self.write(batch))
+        else:
+            self.executor.submit(self.write_in_background, batch)
+
+    def write_in_background(self, batch):
+        responses = self.write(batch)
+        self.connection.add_callback_threadsafe(functools.partial(self.reply, batch, responses))
+
+    def write(self, batch):
+        with HANDLER_SECONDS.labels(TRANSACTION_QUEUE).time():
+            return self.write_batch(batch)
+
+    def write_batch(self, batch):
+        try:
+            messages = [rpc_codec.decode(body, properties.content_type) for _, properties, body in batch]
+            transaction_ids = database.add_transactions_batch(
+                [(m['user_id'], m['type'], m['category'], m['amount']) for m in messages],
+                [m.get('idempotency_key') for m in messages]
+            )
+            print(f"Batch of {len(batch)} transactions added.")
+            return [{'status': 'success', 'transaction_id': tx_id} for tx_id in transaction_ids]
+        except Exception as e:
+            print(f"Batch of {len(batch)} failed ({e}), falling back to single inserts")
+            return [handle(transaction_handler, body, properties.content_type) for _, properties, body in batch]
+
+    def reply(self, batch, responses):
+        for (_, properties, _), response in zip(batch, responses):
+            respond(self.channel, properties, response)
+        self.channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+
+
+def resolve_pools(pools):
+    """Подставляет вместо '*' очереди, не назначенные явно ни одной группе."""
+    assigned = {queue for _, queues, _, _ in pools for queue in queues if queue != '*'}
+    rest = [queue for queue in HANDLERS if queue not in assigned]
+    return [(name, rest if queues == ['*'] else queues, min_size, max_size)
+            for name, queues, min_size, max_size in pools]
+
+
+def check_cache_backend(pools):
+    """CACHE_BACKEND=memory допустим только с одним процессом-воркером.
+
+    Запись сбрасывает кеш лишь в процессе, который её сделал, а чтения идут
+    в других процессах и контейнерах: списки и учётные данные (в том числе
+    удалённого пользователя) отдавались бы устаревшими до CACHE_TTL.
+    """
+    processes = sum(max_size for _, _, _, max_size in pools)
+    if cache.CACHE_BACKEND == 'memory' and processes > 1:
+        raise ValueError(f"CACHE_BACKEND=memory needs a single worker process, WORKER_POOLS allows {processes}; "
+                         f"use redis or none")
 
 
 # --- Один воркер ---
-def start_worker():
+def start_worker(queues=None):
+    """Воркер, потребляющий queues (по умолчанию — все очереди)."""
+    queues = list(HANDLERS) if queues is None else queues
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
     channel = connection.channel()
+    channels, batcher = [channel], None
+
+    # объявляем все очереди, чтобы шлюзу было куда публиковать независимо от набора пулов
+    for queue in HANDLERS:
+        channel.queue_declare(queue=queue, durable=True)
+
+    concurrency = {queue: queue_concurrency(queue) for queue in queues}
+    if TRANSACTION_BATCH_SIZE > 1 and TRANSACTION_QUEUE in concurrency:
+        # пачки пишет свой однопоточный executor, см. TransactionBatcher
+        concurrency[TRANSACTION_QUEUE] = min(concurrency[TRANSACTION_QUEUE], 1)
+    # долгим обработчикам executor нужен всегда: на потоке соединения они остановили бы heartbeat
+    executors = {queue: ThreadPoolExecutor(max_workers=n, thread_name_prefix=queue)
+                 for queue, n in concurrency.items() if n > 1 or queue in LONG_RUNNING_QUEUES}
+    threads = sum(n for queue, n in concurrency.items() if queue in executors)
+    if threads > database.DB_POOL_MAX:
+        print(f"Warning: {threads} handler threads share DB_POOL_MAX={database.DB_POOL_MAX} connections")
+
+    for queue in queues:
+        if queue == TRANSACTION_QUEUE and TRANSACTION_BATCH_SIZE > 1:
+            continue
+        # В RabbitMQ basic_qos без global задаёт лимит для каждого следующего консьюмера канала,
+        # поэтому prefetch у каждой очереди свой; не меньше числа потоков, иначе часть простаивает
+        channel.basic_qos(prefetch_count=max(QUEUE_PREFETCH.get(queue, PREFETCH_COUNT), concurrency[queue]))
+        if queue in STREAM_QUEUES:
+            callback = make_stream_callback(queue, HANDLERS[queue], executors[queue])
+        else:
+            callback = make_callback(queue, HANDLERS[queue], executors.get(queue))
+        channel.basic_consume(queue=queue, on_message_callback=callback)
+
+    if TRANSACTION_QUEUE in queues and TRANSACTION_BATCH_SIZE > 1:
+        # Отдельный канал: на нём неподтверждёнными бывают только сообщения текущей пачки
+        batch_channel = connection.channel()
+        batch_channel.basic_qos(prefetch_count=max(QUEUE_PREFETCH.get(TRANSACTION_QUEUE, PREFETCH_COUNT),
+                                                   TRANSACTION_BATCH_SIZE))
+        batch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='batch') \
+            if queue_concurrency(TRANSACTION_QUEUE) > 1 else None
+        batcher = TransactionBatcher(connection, batch_channel, TRANSACTION_BATCH_SIZE, TRANSACTION_BATCH_MS,
+                                     batch_executor)
+        batch_channel.basic_consume(queue=TRANSACTION_QUEUE, on_message_callback=batcher.on_message)
+        channels.append(batch_channel)
+        if batch_executor is not None:
+            executors[TRANSACTION_QUEUE + ':batch'] = batch_executor
 
-    channel.queue_declare(queue=REGISTER_QUEUE, durable=True)
-    channel.queue_declare(queue=LOGIN_QUEUE, durable=True)
-    channel.queue_declare(queue=TRANSACTION_QUEUE, durable=True)
-    channel.queue_declare(queue=TRANSACTION_GET_QUEUE, durable=True)
-    channel.queue_declare(queue=DELETE_TRANSACTION_QUEUE, durable=True)
-    channel.queue_declare(queue=DELETE_USER_QUEUE, durable=True)
+    # SIGTERM от супервизора: дорабатываем взятые сообщения и выходим
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    # Рекомендуется явно указать prefetch_count > 1
-    channel.basic_qos(prefetch_count=10)
+    print(f"[PID {multiprocessing.current_process().pid}] Worker started for {', '.join(queues)}.")
+    while not stopping.is_set():
+        connection.process_data_events(time_limit=1)
+    drain_worker(connection, channels, list(executors.values()), batcher)
 
-    channel.basic_consume(queue=REGISTER_QUEUE, on_message_callback=register_callback)
-    channel.basic_consume(queue=LOGIN_QUEUE, on_message_callback=login_callback)
-    channel.basic_consume(queue=TRANSACTION_QUEUE, on_message_callback=transaction_callback)
-    channel.basic_consume(queue=TRANSACTION_GET_QUEUE, on_message_callback=transaction_get_callback)
-    channel.basic_consume(queue=DELETE_TRANSACTION_QUEUE, on_message_callback=transaction_delete_callback)
-    channel.basic_consume(queue=DELETE_USER_QUEUE, on_message_callback=delete_user_callback)
 
-    print(f"[PID {multiprocessing.current_process().pid}] Worker started.")
-    channel.start_consuming()
+def drain_worker(connection, channels, executors, batcher=None):
+    """Отменяет подписки и ждёт, пока executors доделают начатое.
 
+    Сообщения, которые ещё не дошли до обработчиков, pika отклоняет при
+    отмене подписки, и брокер возвращает их в очередь. Ответы и ack из
+    executors публикуются на потоке соединения, поэтому, пока те
+    работают, события соединения продолжают обрабатываться.
+    """
+    pid = multiprocessing.current_process().pid
+    print(f"[PID {pid}] Worker stopping…")
+    for channel in channels:
+        for consumer_tag in list(channel.consumer_tags):
+            channel.basic_cancel(consumer_tag)
+    if batcher is not None:
+        batcher.flush()
 
-# --- Запуск нескольких воркеров ---
+    drained = threading.Thread(target=lambda: [executor.shutdown(wait=True) for executor in executors])
+    drained.start()
+    deadline = time.time() + autoscaler.WORKER_SHUTDOWN_TIMEOUT
+    while drained.is_alive() and time.time() < deadline:
+        connection.process_data_events(time_limit=0.1)
+    if drained.is_alive():
+        # неподтверждённые сообщения брокер отдаст другим воркерам после закрытия соединения
+        print(f"[PID {pid}] Handlers did not finish in {autoscaler.WORKER_SHUTDOWN_TIMEOUT}s, exiting anyway")
+        connection.close()
+        os._exit(1)
+    connection.process_data_events(time_limit=0)
+    connection.close()
+    passwords.shutdown_executor()
+    print(f"[PID {pid}] Worker stopped.")
+
+
+# --- Запуск пулов воркеров ---
 if __name__ == "__main__":
-    processes = []
-    for _ in range(NUM_WORKERS):
-        p = multiprocessing.Process(target=start_worker)
-        p.start()
-        processes.append(p)
-
-    for p in processes:
-        p.join()
+    pools = resolve_pools(WORKER_POOLS)
+    check_cache_backend(pools)
+    database.run_migrations()
+    metrics.start_metrics_server()
+
+    # будущие секции transactions и архивирование старых — в своём процессе.
+    # Первый проход тоже в дочернем: purge_idempotency_keys поднимает пул,
+    # а его соединения не должны достаться воркерам через fork.
+    first_pass = multiprocessing.Process(target=partitions.run_maintenance)
+    first_pass.start()
+    first_pass.join()
+    multiprocessing.Process(target=partitions.maintenance_loop, daemon=True).start()
+
+    # пулы воркеров; размер каждого меняется по глубине его очередей
+    autoscaler.Supervisor(start_worker, pools).run()
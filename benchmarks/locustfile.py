@@ -0,0 +1,65 @@
+"""Headless-сценарии Locust для benchmarks/run.py.
+
+Классы пользователей выбираются по сценарию (см. SCENARIOS в run.py):
+WriterUser повторяет профиль load_tester_ui (запись 10:1 к логину),
+ReaderUser читает списки транзакций и сводку.
+"""
+import random
+import uuid
+
+from locust import HttpUser, between, task
+
+
+class BenchUser(HttpUser):
+    abstract = True
+    wait_time = between(0.05, 0.2)
+
+    def on_start(self):
+        self.creds = {'username': f"bench_{uuid.uuid4()}", 'password': 'password123'}
+        self.client.post('/api/register', json=self.creds, name='/api/register')
+        self.user_id = None
+        self.login()
+
+    def login(self):
+        response = self.client.post('/api/login', json=self.creds, name='/api/login')
+        if response.status_code == 200:
+            data = response.json()
+            self.user_id = data.get('user_id')
+            # дальше шлюз проверяет только токен, без обращения к воркерам
+            self.client.headers['Authorization'] = f"Bearer {data['token']}"
+
+    def add_transaction(self):
+        self.client.post('/api/transaction', name='/api/transaction', json={
+            'user_id': self.user_id,
+            'type': random.choice(['income', 'expense']),
+            'category': random.choice(['food', 'transport', 'salary', 'gifts']),
+            'amount': random.randint(100, 5000),
+        })
+
+
+class WriterUser(BenchUser):
+    @task(10)
+    def write(self):
+        if self.user_id:
+            self.add_transaction()
+
+    @task(1)
+    def relogin(self):
+        self.login()
+
+
+class ReaderUser(BenchUser):
+    def on_start(self):
+        super().on_start()
+        for _ in range(20):
+            if self.user_id:
+                self.add_transaction()
+
+    @task(5)
+    def transactions(self):
+        self.client.get(f"/api/transactions?user_id={self.user_id}&type={random.choice(['income', 'expense'])}",
+                        name='/api/transactions')
+
+    @task(2)
+    def summary(self):
+        self.client.get(f"/api/summary?user_id={self.user_id}", name='/api/summary')
@@ -0,0 +1,118 @@
+"""Микробенчмарки функций database.py и RpcClient.call.
+
+Работают против локальных Postgres (DB_HOST, схема из init.sql + миграции)
+и RabbitMQ (RABBITMQ_HOST). Вместо настоящего бэкенда RPC обслуживает
+эхо-воркер в этом же процессе, так что замеряется только транспорт.
+"""
+import json
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+sys.path.insert(0, os.path.join(ROOT, 'api_gateway'))
+
+import database  # noqa: E402
+
+BENCH_RPC_QUEUE = 'bench_rpc_queue'
+
+
+def summarize(latencies, elapsed):
+    """Пропускная способность и перцентили (мс) по списку длительностей в секундах."""
+    ordered = sorted(latencies)
+
+    def percentile(q):
+        return round(ordered[max(0, math.ceil(q * len(ordered)) - 1)] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'ops_per_sec': round(len(ordered) / elapsed, 1),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+    }
+
+
+def measure(func, iterations):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def bench_database(iterations):
+    username = f"bench_{uuid.uuid4().hex[:8]}"
+    user_id = database.create_user(username, 'password123')[0]
+    results = {}
+    try:
+        results['db.create_user'] = measure(
+            lambda i: database.create_user(f"{username}_{i}", 'password123'), iterations)
+        results['db.get_credentials'] = measure(
+            lambda i: database.get_credentials(username), iterations)
+
+        created = []
+        results['db.add_transaction'] = measure(
+            lambda i: created.append(database.add_transaction(user_id, 'expense', 'food', 100 + i)), iterations)
+        results['db.add_transactions_batch(10)'] = measure(
+            lambda i: database.add_transactions_batch([(user_id, 'income', 'salary', 1000)] * 10),
+            max(1, iterations // 10))
+        results['db.get_transactions'] = measure(
+            lambda i: database.get_transactions(user_id, 'expense', limit=100), iterations)
+        results['db.get_summary'] = measure(
+            lambda i: database.get_summary(user_id), iterations)
+        results['db.delete_transaction'] = measure(
+            lambda i: database.delete_transaction(created[i]), len(created))
+    finally:
+        database.delete_user(user_id)
+        with database.pooled_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM users WHERE username LIKE %s;", (username + '\\_%',))
+            conn.commit()
+    return results
+
+
+def start_echo_worker(host, ready):
+    """Фейковый воркер: отвечает на каждое сообщение BENCH_RPC_QUEUE как успешный бэкенд."""
+    import pika
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+    channel.queue_declare(queue=BENCH_RPC_QUEUE, auto_delete=True)
+
+    def on_message(ch, method, properties, body):
+        ch.basic_publish(
+            exchange='',
+            routing_key=properties.reply_to,
+            body=json.dumps({'status': 'success'}),
+            properties=pika.BasicProperties(correlation_id=properties.correlation_id)
+        )
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    channel.basic_consume(queue=BENCH_RPC_QUEUE, on_message_callback=on_message)
+    ready.set()
+    channel.start_consuming()
+
+
+def bench_rpc(iterations):
+    import api_gateway
+
+    ready = threading.Event()
+    threading.Thread(target=start_echo_worker, args=(api_gateway.RABBITMQ_HOST, ready), daemon=True).start()
+    ready.wait()
+    client = api_gateway.RpcClient()
+    return {'rpc.call': measure(lambda i: client.call(BENCH_RPC_QUEUE, {'i': i}), iterations)}
+
+
+def run(iterations=500, targets=('db', 'rpc')):
+    results = {}
+    if 'db' in targets:
+        results.update(bench_database(iterations))
+    if 'rpc' in targets:
+        results.update(bench_rpc(iterations))
+    return results
@@ -0,0 +1,91 @@
+"""Сравнение пропускной способности регистрации: старый цикл из 5 INSERT против одного запроса.
+
+Замеряется только работа с БД внутри register_handler из backend/server.py.
+Обработчик получает {"username": ..., "password": ...}, считает scrypt-хеш
+пароля и вызывает database.create_user, который возвращает
+(user_id, создан ли, сохранённый хеш). Клиенту уходит
+{"status": "success", "user_id": ...} — и на новую регистрацию, и на повтор
+с тем же паролем — или {"status": "failure", "error": ...}, если логин занят.
+Хеширование в замер не входит; обе функции ниже возвращают user_id из ответа.
+
+Запуск против локального Postgres со схемой из init.sql:
+
+    DB_HOST=localhost python benchmarks/register_bench.py --users 2000 --concurrency 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+
+import psycopg2  # noqa: E402
+
+import database  # noqa: E402
+
+
+def legacy_register(username, password):
+    """Прежний register_callback: 5 вызовов create_user, каждый со своим соединением."""
+    user_id = None
+    for _ in range(5):
+        conn = database.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s) RETURNING id;", (username, password))
+            new_user_id = cursor.fetchone()[0]
+            conn.commit()
+            if user_id is None:
+                user_id = new_user_id
+        except psycopg2.IntegrityError:
+            conn.rollback()
+        finally:
+            cursor.close()
+            conn.close()
+    return user_id
+
+
+def pooled_register(username, password):
+    """Текущий путь без хеширования пароля: замеряется только работа с БД."""
+    user_id, _, _ = database.create_user(username, password)
+    return user_id
+
+
+def measure(register, users, concurrency):
+    prefix = f"bench_{uuid.uuid4().hex[:8]}"
+    names = [f"{prefix}_{i}" for i in range(users)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda name: register(name, 'password123'), names))
+    elapsed = time.perf_counter() - started
+    cleanup(prefix)
+    return {'users': users, 'seconds': round(elapsed, 3), 'registrations_per_sec': round(users / elapsed, 1)}
+
+
+def cleanup(prefix):
+    conn = database.get_db_connection()
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM users WHERE username LIKE %s;", (prefix + '\\_%',))
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=database.DB_POOL_MAX)
+    args = parser.parse_args()
+
+    results = {
+        'before': measure(legacy_register, args.users, args.concurrency),
+        'after': measure(pooled_register, args.users, args.concurrency),
+    }
+    results['speedup'] = round(
+        results['after']['registrations_per_sec'] / results['before']['registrations_per_sec'], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Воспроизводимые бенчмарки: микробенчмарки и headless Locust с JSON-отчётом.
+
+Примеры (локальные Postgres и RabbitMQ или поднятый docker-compose):
+
+    DB_HOST=localhost RABBITMQ_HOST=localhost python benchmarks/run.py micro -o micro.json
+    python benchmarks/run.py locust --scenario mixed --host http://localhost:8080 -o load.json
+    python benchmarks/run.py compare load.json benchmarks/baseline-load.json --tolerance 0.1
+
+Каждый отчёт содержит для каждого замера count, ops_per_sec и p50/p95/p99
+в миллисекундах. compare завершается с кодом 1, если пропускная
+способность упала или p99 вырос больше чем на tolerance.
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Сценарий -> классы пользователей из benchmarks/locustfile.py
+SCENARIOS = {
+    'writes': ['WriterUser'],
+    'reads': ['ReaderUser'],
+    'mixed': ['WriterUser', 'ReaderUser'],
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(kind, params, results):
+    return {
+        'meta': {
+            'kind': kind,
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'params': params,
+        },
+        'results': results,
+    }
+
+
+def run_micro(args):
+    # по умолчанию меряем саму БД, а не попадания в кеш
+    os.environ.setdefault('CACHE_BACKEND', args.cache)
+    import micro
+    return micro.run(args.iterations, args.targets.split(','))
+
+
+def run_locust(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = os.path.join(tmp, 'stats')
+        subprocess.run([
+            'locust', '-f', os.path.join(BENCH_DIR, 'locustfile.py'),
+            '--headless', '--only-summary',
+            '--users', str(args.users), '--spawn-rate', str(args.spawn_rate),
+            '--run-time', args.duration, '--host', args.host,
+            '--csv', prefix,
+            *SCENARIOS[args.scenario],
+        ], check=True)
+        return parse_locust_stats(prefix + '_stats.csv')
+
+
+def parse_locust_stats(path):
+    results = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            name = 'http.total' if row['Name'] == 'Aggregated' else f"http.{row['Type']} {row['Name']}"
+            results[name] = {
+                'count': int(row['Request Count']),
+                'failures': int(row['Failure Count']),
+                'ops_per_sec': round(float(row['Requests/s']), 1),
+                'p50_ms': float(row['50%']),
+                'p95_ms': float(row['95%']),
+                'p99_ms': float(row['99%']),
+            }
+    return results
+
+
+def compare(current, baseline, tolerance):
+    """Возвращает список регрессий относительно baseline."""
+    regressions = []
+    for name, base in baseline['results'].items():
+        now = current['results'].get(name)
+        if now is None:
+            continue
+        if now['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: ops_per_sec {base['ops_per_sec']} -> {now['ops_per_sec']}")
+        if now['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99_ms {base['p99_ms']} -> {now['p99_ms']}")
+    return regressions
+
+
+def write_report(data, output):
+    text = json.dumps(data, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+def check_baseline(data, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = compare(data, baseline, tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def add_common(p):
+        p.add_argument('-o', '--output', help='куда сохранить JSON-отчёт')
+        p.add_argument('--baseline', help='сравнить с сохранённым отчётом')
+        p.add_argument('--tolerance', type=float, default=0.1)
+
+    micro_parser = sub.add_parser('micro', help='database.py и RpcClient.call')
+    micro_parser.add_argument('--iterations', type=int, default=500)
+    micro_parser.add_argument('--targets', default='db,rpc')
+    micro_parser.add_argument('--cache', default='none', help='CACHE_BACKEND на время замера')
+    add_common(micro_parser)
+
+    locust_parser = sub.add_parser('locust', help='headless нагрузка через HTTP')
+    locust_parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+    locust_parser.add_argument('--users', type=int, default=50)
+    locust_parser.add_argument('--spawn-rate', type=int, default=10)
+    locust_parser.add_argument('--duration', default='60s')
+    locust_parser.add_argument('--host', default='http://localhost:8080')
+    add_common(locust_parser)
+
+    compare_parser = sub.add_parser('compare', help='сравнить два отчёта')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.current) as f:
+            current = json.load(f)
+        return check_baseline(current, args.baseline, args.tolerance)
+
+    if args.command == 'micro':
+        params = {'iterations': args.iterations, 'targets': args.targets, 'cache': args.cache}
+        data = report('micro', params, run_micro(args))
+    else:
+        params = {'scenario': args.scenario, 'users': args.users, 'spawn_rate': args.spawn_rate,
+                  'duration': args.duration, 'host': args.host}
+        data = report('locust', params, run_locust(args))
+
+    write_report(data, args.output)
+    return check_baseline(data, args.baseline, args.tolerance) if args.baseline else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
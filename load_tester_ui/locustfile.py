@@ -78,4 +78,5 @@ class WebsiteUser(HttpUser):
             else:
                 data = response.json()
                 self.user_id = data.get('user_id')
+                self.client.headers['Authorization'] = f"Bearer {data['token']}"
                 response.success()
\ No newline at end of file